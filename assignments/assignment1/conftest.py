@@ -0,0 +1 @@
+# Lets pytest import the cs231n package of this assignment from tests/.
@@ -1,2 +1,3 @@
 from cs231n.classifiers.k_nearest_neighbor import *
+from cs231n.classifiers.ann_index import *
 from cs231n.classifiers.linear_classifier import *
@@ -0,0 +1,244 @@
+from __future__ import print_function
+
+import time
+
+import numpy as np
+
+from cs231n.classifiers.k_nearest_neighbor import _smallest_k
+
+
+class IVFPQIndex(object):
+    """
+    An approximate nearest neighbor index using an inverted file (IVF) with
+    product-quantized (PQ) residuals, implemented with plain numpy.
+
+    Training points are first clustered with k-means into num_lists coarse
+    cells; each point is stored in the inverted list of its nearest cell. The
+    residual between a point and its cell centroid is split into
+    num_subvectors chunks and every chunk is replaced by the index of its
+    nearest centroid in a small per-chunk codebook, so a point is stored as
+    num_subvectors uint8 codes instead of D floats.
+
+    At query time only the num_probes cells closest to the query are scanned,
+    and distances to their members are approximated with per-query lookup
+    tables. num_probes is the recall / latency knob: probing every list
+    touches every point, while probing a few lists is much faster.
+
+    Example usage:
+
+    classifier = KNearestNeighbor()
+    classifier.train(X_train, y_train, index=IVFPQIndex(num_lists=100))
+    classifier.index.num_probes = 4
+    y_pred = classifier.predict(X_test, k=5)
+    """
+
+    def __init__(self, num_lists=64, num_subvectors=8, num_probes=8,
+                 num_iters=10, max_train_points=20000, seed=0):
+        """
+        Inputs:
+        - num_lists: Number of coarse k-means cells (inverted lists).
+        - num_subvectors: Number of chunks each residual is split into; each
+          chunk is encoded with one byte.
+        - num_probes: Number of closest lists scanned per query.
+        - num_iters: Number of k-means iterations used to build the coarse
+          centroids and the PQ codebooks.
+        - max_train_points: Train the quantizers on at most this many randomly
+          chosen points; all points are still encoded.
+        - seed: Seed for the random number generator used during training.
+        """
+        self.num_lists = num_lists
+        self.num_subvectors = num_subvectors
+        self.num_probes = num_probes
+        self.num_iters = num_iters
+        self.max_train_points = max_train_points
+        self.seed = seed
+
+    def fit(self, X):
+        """
+        Build the index over the rows of X.
+
+        Inputs:
+        - X: A numpy array of shape (N, D) containing the points to index.
+        """
+        rng = np.random.RandomState(self.seed)
+        X = np.asarray(X, dtype=np.float32)
+        N, D = X.shape
+        num_subvectors = min(self.num_subvectors, D)
+
+        sample = X
+        if N > self.max_train_points:
+            sample = X[rng.choice(N, self.max_train_points, replace=False)]
+        # k-means needs at least as many sample points as clusters.
+        num_lists = min(self.num_lists, len(sample))
+
+        # Coarse quantizer.
+        self.centroids = _kmeans(sample, num_lists, self.num_iters, rng)
+        assignments = _nearest_centroid(X, self.centroids)
+
+        # Product quantizer on the residuals; each chunk gets a codebook of at
+        # most 256 centroids so that codes fit in a uint8.
+        residuals = X - self.centroids[assignments]
+        sample_residuals = residuals
+        if N > self.max_train_points:
+            sample_residuals = residuals[rng.choice(N, self.max_train_points,
+                                                    replace=False)]
+        self.subspaces = np.array_split(np.arange(D), num_subvectors)
+        codebook_size = min(256, len(sample_residuals))
+        self.codebooks = []
+        codes = np.empty((N, num_subvectors), dtype=np.uint8)
+        for m, dims in enumerate(self.subspaces):
+            codebook = _kmeans(sample_residuals[:, dims], codebook_size,
+                               self.num_iters, rng)
+            self.codebooks.append(codebook)
+            codes[:, m] = _nearest_centroid(residuals[:, dims], codebook)
+
+        # Lay the inverted lists out contiguously: list l owns the entries
+        # list_offsets[l]:list_offsets[l + 1] of codes and ids.
+        order = np.argsort(assignments, kind='mergesort')
+        self.ids = order
+        self.codes = codes[order]
+        list_sizes = np.bincount(assignments, minlength=num_lists)
+        self.list_offsets = np.concatenate(([0], np.cumsum(list_sizes)))
+        return self
+
+    def search(self, X, k=1, num_probes=None):
+        """
+        Find approximate k nearest neighbors of every row of X.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing query points.
+        - k: The number of neighbors to return for each query.
+        - num_probes: Number of lists to scan; defaults to self.num_probes.
+
+        Returns a tuple of:
+        - nearest_dists: A numpy array of shape (num_test, k) holding the
+          approximate l2 distances in ascending order. Queries whose probed
+          lists hold fewer than k points are padded with np.inf.
+        - nearest_idx: A numpy array of shape (num_test, k) holding the indices
+          of the neighbors in the indexed data, padded with -1.
+        """
+        if num_probes is None:
+            num_probes = self.num_probes
+        X = np.asarray(X, dtype=np.float32)
+        num_test = X.shape[0]
+        k = min(k, len(self.ids))
+        num_lists = self.centroids.shape[0]
+        num_probes = min(num_probes, num_lists)
+
+        coarse_dists = _sq_dists(X, self.centroids)
+        _, probes = _smallest_k(coarse_dists, num_probes)
+
+        best_dists = np.full((num_test, k), np.inf, dtype=np.float32)
+        best_idx = np.full((num_test, k), -1, dtype=np.intp)
+
+        # Scan one inverted list at a time for all queries that probe it, so
+        # the work per list is a handful of vectorized table lookups.
+        for l in np.unique(probes):
+            start, stop = self.list_offsets[l], self.list_offsets[l + 1]
+            if start == stop:
+                continue
+            queries = np.nonzero(np.any(probes == l, axis=1))[0]
+            residuals = X[queries] - self.centroids[l]
+            codes = self.codes[start:stop]
+
+            dists = np.zeros((len(queries), stop - start), dtype=np.float32)
+            for m, dims in enumerate(self.subspaces):
+                # (num_queries, codebook_size) table of chunk distances.
+                table = _sq_dists(residuals[:, dims], self.codebooks[m])
+                dists += table[:, codes[:, m]]
+
+            list_k = min(k, stop - start)
+            list_dists, list_idx = _smallest_k(dists, list_k)
+            merged_dists = np.hstack((best_dists[queries], list_dists))
+            merged_idx = np.hstack((best_idx[queries],
+                                    self.ids[start + list_idx]))
+            best_dists[queries], best_idx[queries] = _smallest_k(
+                merged_dists, k, indices=merged_idx)
+
+        return np.sqrt(np.maximum(best_dists, 0)), best_idx
+
+
+def benchmark_index(classifier, X, k=10, probe_choices=(1, 2, 4, 8, 16)):
+    """
+    Compare the approximate index of a trained KNearestNeighbor against its
+    exact blocked search.
+
+    Inputs:
+    - classifier: A KNearestNeighbor trained with an index.
+    - X: A numpy array of shape (num_test, D) of query points.
+    - k: Number of neighbors used to measure recall.
+    - probe_choices: Values of num_probes to evaluate.
+
+    Returns:
+    A list of dictionaries, the first describing the exact search and then one
+    per value of num_probes, each with keys 'num_probes', 'recall' (fraction
+    of the true k nearest neighbors that were returned) and 'qps' (queries per
+    second).
+    """
+    tic = time.time()
+    _, exact_idx = classifier.compute_k_nearest(X, k=k)
+    exact_time = time.time() - tic
+    results = [{'num_probes': None, 'recall': 1.0,
+                'qps': X.shape[0] / max(exact_time, 1e-12)}]
+
+    for num_probes in probe_choices:
+        tic = time.time()
+        _, approx_idx = classifier.index.search(X, k=k, num_probes=num_probes)
+        approx_time = time.time() - tic
+        hits = sum(np.intersect1d(exact_idx[i], approx_idx[i]).size
+                   for i in range(X.shape[0]))
+        results.append({'num_probes': num_probes,
+                        'recall': hits / float(exact_idx.size),
+                        'qps': X.shape[0] / max(approx_time, 1e-12)})
+
+    return results
+
+
+def _sq_dists(X, centroids):
+    """ Squared l2 distances between the rows of X and the rows of centroids. """
+    dists = np.dot(X, centroids.T)
+    dists *= -2
+    dists += np.sum(np.square(X), axis=1, keepdims=True)
+    dists += np.sum(np.square(centroids), axis=1)
+    return dists
+
+
+def _nearest_centroid(X, centroids, block_size=4096):
+    """ Index of the closest centroid for every row of X, in row blocks. """
+    centroid_sq_norms = np.sum(np.square(centroids), axis=1)
+    assignments = np.empty(X.shape[0], dtype=np.intp)
+    for i in range(0, X.shape[0], block_size):
+        # ||x||^2 is the same for every centroid, so it can be left out.
+        scores = np.dot(X[i:i + block_size], centroids.T)
+        scores *= -2
+        scores += centroid_sq_norms
+        assignments[i:i + block_size] = np.argmin(scores, axis=1)
+    return assignments
+
+
+def _kmeans(X, num_clusters, num_iters, rng):
+    """
+    Lloyd's k-means initialized from randomly chosen rows of X.
+
+    Returns:
+    - centroids: A numpy array of shape (num_clusters, D).
+    """
+    N = X.shape[0]
+    centroids = X[rng.choice(N, num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assignments = _nearest_centroid(X, centroids)
+        counts = np.bincount(assignments, minlength=num_clusters)
+
+        # Sum the members of every cluster with one reduceat over the rows
+        # sorted by cluster.
+        order = np.argsort(assignments, kind='mergesort')
+        nonempty = np.nonzero(counts)[0]
+        starts = np.concatenate(([0], np.cumsum(counts)))[nonempty]
+        sums = np.add.reduceat(X[order], starts, axis=0)
+        centroids[nonempty] = sums / counts[nonempty, np.newaxis]
+
+        # Restart empty clusters from random points.
+        empty = np.nonzero(counts == 0)[0]
+        if len(empty) > 0:
+            centroids[empty] = X[rng.choice(N, len(empty), replace=False)]
+    return centroids
@@ -1,13 +1,43 @@
+import copy
+import multiprocessing
+import weakref
+
 import numpy as np
 
+from cs231n.shared_arrays import (attach_shared_memory, shared_array,
+                                  to_shared_memory)
+
 
 class KNearestNeighbor(object):
-    """ a kNN classifier with L2 distance """
+    """ a kNN classifier with L2, L1 or cosine distance """
 
-    def __init__(self):
-        pass
+    def __init__(self, memory_budget=64 * 1024 ** 2, num_workers=1,
+                 dtype=np.float64):
+        """
+        Inputs:
+        - memory_budget: Approximate number of bytes the blocked distance
+            engine may use for a single tile of test / train distances. Larger
+            budgets mean fewer, bigger matrix multiplies.
+        - num_workers: Number of worker processes used by compute_k_nearest.
+            With more than one worker the training set is split into that many
+            shards, each searched in its own process (each with its own
+            memory_budget), and the per-shard candidates are merged. The
+            processes are started, and the training data moved into shared
+            memory, by the first such search, and kept until close() is
+            called.
+        - dtype: Floating point type the blocked distance engine computes in.
+            With np.float32 the matrix multiplies run at single precision,
+            float64 training data is stored as float32, and the final
+            neighbors are re-ranked with exact float64 distances so that the
+            predicted labels match the float64 computation.
+        """
+        self.memory_budget = memory_budget
+        self.num_workers = num_workers
+        self.dtype = np.dtype(dtype)
+        self.pool = None
+        self.release_workers = None
 
-    def train(self, X, y):
+    def train(self, X, y, index=None, storage_dtype=None):
         """
         Train the classifier. For k-nearest neighbors this is just
         memorizing the training data.
@@ -17,11 +47,110 @@ class KNearestNeighbor(object):
             consisting of num_train samples each of dimension D.
         - y: A numpy array of shape (N,) containing the training labels, where
             y[i] is the label for X[i].
+        - index: Optional approximate nearest neighbor index (such as an
+            IVFPQIndex) to build over X. If given, predict with num_loops=0
+            searches the index instead of scanning every training point.
+        - storage_dtype: Optional numpy datatype to store the training data as,
+            for example np.uint8 for raw pixels. By default X is kept as given
+            (including np.memmap arrays, which stay on disk), except that
+            floating point data wider than self.dtype is narrowed to it.
+
+        X may also be the path of a .npy file, which is memory-mapped rather
+        than read into memory.
+
+        With num_workers > 1, this replaces the worker processes of any
+        earlier training set; call close() when done.
         """
+        # Drop the old training data first so that close() does not copy it
+        # out of shared memory.
+        self.X_train = self.train_sq_norms = None
+        self.close()
+        if isinstance(X, str):
+            X = np.load(X, mmap_mode='r')
+        if storage_dtype is None and X.dtype.kind == 'f' and \
+                X.dtype.itemsize > self.dtype.itemsize:
+            storage_dtype = self.dtype
+        if storage_dtype is not None and X.dtype != storage_dtype:
+            X = X.astype(storage_dtype)
+
         self.X_train = X
         self.y_train = y
 
-    def predict(self, X, k=1, num_loops=0):
+        # The squared norms of the training points never change, so compute
+        # them once here instead of on every call to predict.
+        self.train_sq_norms = _row_sq_norms(X)
+        self.num_classes = int(np.max(y)) + 1
+
+        self.index = index
+        if index is not None:
+            index.fit(X)
+
+    def close(self):
+        """
+        Stop the worker processes of the sharded search and move the training
+        data back out of shared memory. The classifier stays usable: the next
+        sharded search starts them again.
+        """
+        if self.release_workers is not None:
+            if self.X_train is not None:
+                self.X_train = np.array(self.X_train)
+                self.train_sq_norms = np.array(self.train_sq_norms)
+            self.release_workers()
+        self.pool = None
+        self.release_workers = None
+
+    def _unfitted_copy(self):
+        """ A copy with our configuration but no training data or workers. """
+        clone = copy.copy(self)
+        clone.X_train = clone.train_sq_norms = None
+        clone.y_train = clone.index = None
+        clone.pool = clone.release_workers = None
+        return clone
+
+    def _start_workers(self):
+        """
+        Move the training data and its norms into shared memory and start one
+        worker process per shard of it; every sharded search then only has to
+        share its queries. X_train and train_sq_norms are rebound to the
+        shared arrays, so the data is not held twice.
+        """
+        num_train = self.X_train.shape[0]
+        bounds = np.linspace(0, num_train, self.num_workers + 1).astype(int)
+        self.shards = [(start, stop) for start, stop in zip(bounds[:-1],
+                                                            bounds[1:])
+                       if stop > start]
+
+        # The workers only need our configuration; the arrays are shared.
+        template = self._unfitted_copy()
+        template.num_workers = 1
+
+        blocks = []
+        try:
+            specs = []
+            shared = []
+            for array in (self.X_train, self.train_sq_norms):
+                block, spec = to_shared_memory(array)
+                blocks.append(block)
+                specs.append(spec)
+                shared.append(shared_array(block, spec))
+            self.X_train, self.train_sq_norms = shared
+            del shared
+            pool = multiprocessing.Pool(len(self.shards),
+                                        initializer=_init_shard_worker,
+                                        initargs=(template, specs))
+        except BaseException:
+            self.X_train = np.array(self.X_train)
+            self.train_sq_norms = np.array(self.train_sq_norms)
+            _release_workers(None, blocks)
+            raise
+
+        self.pool = pool
+        # Also release them if the classifier is garbage collected (or the
+        # interpreter exits) without a call to close().
+        self.release_workers = weakref.finalize(self, _release_workers, pool,
+                                                blocks)
+
+    def predict(self, X, k=1, num_loops=0, weighted=False, metric='l2'):
         """
         Predict labels for test data using this classifier.
 
@@ -31,13 +160,34 @@ class KNearestNeighbor(object):
         - k: The number of nearest neighbors that vote for the predicted labels.
         - num_loops: Determines which implementation to use to compute distances
                     between training points and testing points.
+        - weighted: If True, each neighbor's vote is weighted by the inverse of
+                    its distance instead of counting once.
+        - metric: One of 'l2', 'l1' or 'cosine'. Only num_loops=0 supports
+                    metrics other than 'l2'.
 
         Returns:
         - y: A numpy array of shape (num_test,) containing predicted labels for the
             test data, where y[i] is the predicted label for the test point X[i].
         """
+        if metric != 'l2' and (num_loops != 0 or self.index is not None):
+            raise ValueError('Metric "%s" requires num_loops=0 and no index'
+                             % metric)
+
         if num_loops == 0:
-            dists = self.compute_distances_no_loops(X)
+            # Stream the distances tile by tile into the top-k reducer so that
+            # the full (num_test, num_train) matrix is never materialized.
+            if self.index is None:
+                nearest_dists, nearest_idx = self.compute_k_nearest(
+                    X, k=k, metric=metric)
+                weights = _inverse_distance(nearest_dists) if weighted else None
+                return self.vote(self.y_train[nearest_idx], weights=weights)
+
+            # The index pads missing neighbors with -1; give those no vote.
+            nearest_dists, nearest_idx = self.index.search(X, k=k)
+            weights = (nearest_idx >= 0).astype(np.float64)
+            if weighted:
+                weights *= _inverse_distance(nearest_dists)
+            return self.vote(self.y_train[nearest_idx], weights=weights)
         elif num_loops == 1:
             dists = self.compute_distances_one_loop(X)
         elif num_loops == 2:
@@ -45,7 +195,7 @@ class KNearestNeighbor(object):
         else:
             raise ValueError('Invalid value %d for num_loops' % num_loops)
 
-        return self.predict_labels(dists, k=k)
+        return self.predict_labels(dists, k=k, weighted=weighted)
 
     def compute_distances_two_loops(self, X):
         """
@@ -61,6 +211,7 @@ class KNearestNeighbor(object):
         is the Euclidean distance between the ith test point and the jth training
         point.
         """
+        X = X.astype(self.dtype, copy=False) # Compact data may be uint8.
         num_test = X.shape[0]
         num_train = self.X_train.shape[0]
         dists = np.zeros((num_test, num_train))
@@ -93,6 +244,7 @@ class KNearestNeighbor(object):
 
         Input / Output: Same as compute_distances_two_loops
         """
+        X = X.astype(self.dtype, copy=False) # Compact data may be uint8.
         num_test = X.shape[0]
         num_train = self.X_train.shape[0]
         dists = np.zeros((num_test, num_train))
@@ -142,10 +294,17 @@ class KNearestNeighbor(object):
         #       and two broadcast sums.                                         #
         #########################################################################
 
-        first_sum = np.sum(np.square(X), axis=1, keepdims=True) # (500, 1)
-        second_sum = np.sum(np.square(self.X_train), axis=1) # (50000,)
-        matmul_term = -2 * np.dot(X, self.X_train.T) # (500, 5000)
-        dists = np.sqrt(first_sum + second_sum + matmul_term)
+        # Expand ||x - y||^2 = ||x||^2 + ||y||^2 - 2 x.y and build the result
+        # in place inside the matrix product to avoid extra (num_test,
+        # num_train) temporaries.
+        X = X.astype(self.dtype, copy=False)
+        X_train = self.X_train.astype(self.dtype, copy=False)
+        dists = np.dot(X, X_train.T) # (500, 5000)
+        dists *= -2
+        dists += _row_sq_norms(X)[:, np.newaxis] # (500, 1)
+        dists += self.train_sq_norms # (5000,)
+        np.maximum(dists, 0, out=dists) # Guard against round-off below zero.
+        np.sqrt(dists, out=dists)
 
         #########################################################################
         #                         END OF YOUR CODE                              #
@@ -153,7 +312,307 @@ class KNearestNeighbor(object):
 
         return dists
 
-    def predict_labels(self, dists, k=1):
+    def _block_shape(self, num_test, num_train, cell_bytes, train_row_bytes=0,
+                     test_row_bytes=0):
+        """
+        Choose how many test rows and train columns to process per tile so
+        that a tile of num_test x num_train entries, each costing cell_bytes,
+        stays within self.memory_budget. Whole training rows are preferred
+        because they give the largest matrix multiplies and the fewest merges.
+
+        train_row_bytes and test_row_bytes are the extra bytes every train or
+        test row of a tile costs on top of its distances, e.g. for a float copy
+        of compactly stored data. When training rows cost extra, at most half
+        the budget goes to them so that the tile still has room for a large
+        block of test rows.
+        """
+        budget = self.memory_budget
+        train_block = num_train
+        if train_row_bytes > 0:
+            train_block = min(train_block,
+                              max(budget // 2 // train_row_bytes, 1))
+            budget = max(budget - train_block * train_row_bytes, 0)
+        max_cells = max(budget // cell_bytes, 1)
+        train_block = int(min(train_block, max_cells))
+        test_bytes = train_block * cell_bytes + test_row_bytes
+        test_block = int(max(min(num_test, budget // test_bytes), 1))
+        return test_block, train_block
+
+    def _dists_block(self, X_block, test_sq_norms, start, stop, metric):
+        """
+        Compute the distances between a block of test points and the training
+        points self.X_train[start:stop]. For the l2 metric squared distances
+        are returned, which rank the same way and save the square roots.
+
+        Inputs:
+        - X_block: A numpy array of shape (block_test, D).
+        - test_sq_norms: A numpy array of shape (block_test,) holding the
+            squared norms of the rows of X_block.
+        - start, stop: Range of training points to compare against.
+        - metric: One of 'l2', 'l1' or 'cosine'.
+
+        Returns:
+        - dists: A numpy array of shape (block_test, stop - start).
+        """
+        X_train_block = self.X_train[start:stop].astype(self.dtype, copy=False)
+
+        if metric == 'l1':
+            # Broadcast to (block_test, block_train, D); _block_shape sizes the
+            # tiles so that this temporary fits the memory budget.
+            differences = X_block[:, np.newaxis, :] - X_train_block
+            return np.sum(np.abs(differences, out=differences), axis=2)
+
+        dists = np.dot(X_block, X_train_block.T)
+        if metric == 'cosine':
+            # 1 - cos(x, y) from one GEMM, scaling by the inverse norms in
+            # place. All-zero vectors get a norm of 1 (cosine 0).
+            dists /= _safe_norms(test_sq_norms)[:, np.newaxis]
+            dists /= _safe_norms(self.train_sq_norms[start:stop])
+            np.subtract(1, dists, out=dists)
+            return dists
+
+        dists *= -2
+        dists += test_sq_norms[:, np.newaxis]
+        dists += self.train_sq_norms[start:stop]
+        np.maximum(dists, 0, out=dists)
+        return dists
+
+    def _exact_dists(self, X_block, candidates, metric):
+        """
+        Compute float64 distances (squared for l2) between each row of X_block
+        and its candidate training points.
+
+        Inputs:
+        - X_block: A numpy array of shape (block_test, D).
+        - candidates: A numpy array of shape (block_test, c) of indices into
+            self.X_train.
+        - metric: One of 'l2', 'l1' or 'cosine'.
+
+        Returns:
+        - dists: A numpy array of shape (block_test, c).
+        """
+        X_block = X_block.astype(np.float64)
+        dists = np.empty(candidates.shape)
+        if metric == 'cosine':
+            test_norms = _safe_norms(_row_sq_norms(X_block))
+        # One column of candidates at a time keeps the temporaries at
+        # (block_test, D) instead of (block_test, c, D).
+        for j in range(candidates.shape[1]):
+            X_train_rows = self.X_train[candidates[:, j]]
+            if metric == 'l2':
+                differences = X_block - X_train_rows
+                dists[:, j] = np.sum(np.square(differences), axis=1)
+            elif metric == 'l1':
+                dists[:, j] = np.sum(np.abs(X_block - X_train_rows), axis=1)
+            else:
+                dots = np.sum(X_block * X_train_rows, axis=1)
+                train_norms = _safe_norms(self.train_sq_norms[candidates[:, j]])
+                dists[:, j] = 1 - dots / (test_norms * train_norms)
+        return dists
+
+    def compute_k_nearest(self, X, k=1, metric='l2'):
+        """
+        Find the k nearest training points of every test point in X without
+        ever building the full distance matrix. Test and train points are
+        processed in tiles sized by self.memory_budget; each tile is reduced
+        to its k best candidates, which are merged into a running top-k.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: The number of neighbors to return for each test point.
+        - metric: 'l2' (Euclidean), 'l1' (Manhattan) or 'cosine' (one minus
+            the cosine similarity).
+
+        Returns a tuple of:
+        - nearest_dists: A numpy array of shape (num_test, k) holding the
+            distances to the k nearest training points in ascending order.
+        - nearest_idx: A numpy array of shape (num_test, k) holding the indices
+            into self.X_train of those training points.
+        """
+        if metric not in ('l2', 'l1', 'cosine'):
+            raise ValueError('Invalid metric "%s"' % metric)
+        if self.num_workers > 1:
+            return self._compute_k_nearest_sharded(X, k, metric)
+
+        num_test = X.shape[0]
+        num_train = self.X_train.shape[0]
+        k = min(k, num_train)
+
+        # Below double precision, keep a few extra candidates per test point
+        # and re-rank them exactly so round-off cannot change the neighbors.
+        exact = self.dtype == np.float64
+        num_candidates = k if exact else min(num_train, 2 * k + 16)
+        # Each tile entry costs one distance plus roughly one index worth of
+        # scratch space for the partial selection; L1 also needs the
+        # broadcast differences along D.
+        cell_bytes = self.dtype.itemsize + np.dtype(np.intp).itemsize
+        if metric == 'l1':
+            cell_bytes += self.dtype.itemsize * X.shape[1]
+        # Compactly stored (e.g. uint8) training data is cast to self.dtype a
+        # block at a time, and the exact re-ranking works on float64 copies of
+        # the test rows.
+        row_bytes = self.dtype.itemsize * X.shape[1]
+        train_row_bytes = 0
+        if self.X_train.dtype != self.dtype:
+            train_row_bytes = row_bytes
+        test_row_bytes = 0
+        if X.dtype != self.dtype:
+            test_row_bytes += row_bytes
+        if not exact:
+            test_row_bytes += 3 * np.dtype(np.float64).itemsize * X.shape[1]
+        test_block, train_block = self._block_shape(
+            num_test, num_train, cell_bytes, train_row_bytes, test_row_bytes)
+
+        nearest_dists = np.empty((num_test, k))
+        nearest_idx = np.empty((num_test, k), dtype=np.intp)
+
+        for i in range(0, num_test, test_block):
+            X_block = X[i:i + test_block].astype(self.dtype, copy=False)
+            test_sq_norms = _row_sq_norms(X_block)
+            best_dists = None
+            best_idx = None
+
+            for start in range(0, num_train, train_block):
+                stop = min(start + train_block, num_train)
+                dists = self._dists_block(X_block, test_sq_norms,
+                                          start, stop, metric)
+                block_dists, block_idx = _smallest_k(
+                    dists, min(num_candidates, stop - start))
+                block_idx += start
+
+                if best_dists is not None:
+                    block_dists = np.hstack((best_dists, block_dists))
+                    block_idx = np.hstack((best_idx, block_idx))
+                best_dists, best_idx = _smallest_k(
+                    block_dists, min(num_candidates, block_dists.shape[1]),
+                    indices=block_idx)
+
+            if not exact:
+                best_dists = self._exact_dists(X[i:i + test_block],
+                                               best_idx, metric)
+                best_dists, best_idx = _smallest_k(best_dists, k,
+                                                   indices=best_idx)
+
+            if metric == 'l2':
+                best_dists = np.sqrt(best_dists)
+            nearest_dists[i:i + test_block] = best_dists
+            nearest_idx[i:i + test_block] = best_idx
+
+        return nearest_dists, nearest_idx
+
+    def _compute_k_nearest_sharded(self, X, k, metric):
+        """
+        Process-parallel version of compute_k_nearest. The workers started by
+        train() already share the training data, so only the queries are
+        placed in shared memory here; each worker finds the top-k candidates
+        of one contiguous shard of the training set, and the shards'
+        candidates are merged here.
+        """
+        if self.pool is None:
+            self._start_workers()
+        k = min(k, self.X_train.shape[0])
+
+        block, spec = to_shared_memory(X)
+        try:
+            results = self.pool.map(_search_shard,
+                                    [(start, stop, k, metric, spec)
+                                     for start, stop in self.shards])
+        finally:
+            block.close()
+            block.unlink()
+
+        nearest_dists = np.hstack([dists for dists, _ in results])
+        nearest_idx = np.hstack([idx for _, idx in results])
+        return _smallest_k(nearest_dists, k, indices=nearest_idx)
+
+    def vote(self, closest_y, weights=None):
+        """
+        Given the labels of the nearest neighbors of each test point, predict
+        the most common label, breaking ties by choosing the smaller label.
+
+        Inputs:
+        - closest_y: A numpy array of shape (num_test, k) where closest_y[i]
+        holds the labels of the k nearest neighbors of the ith test point.
+        - weights: Optional numpy array of shape (num_test, k) giving the weight
+        of each neighbor's vote. By default every neighbor counts once.
+
+        Returns:
+        - y: A numpy array of shape (num_test,) containing predicted labels.
+        """
+        num_test = closest_y.shape[0]
+        num_classes = max(self.num_classes, int(np.max(closest_y)) + 1)
+
+        # Give every test point its own range of num_classes bins so that a
+        # single bincount tallies the votes of all test points at once.
+        offsets = np.arange(num_test)[:, np.newaxis] * num_classes
+        if weights is not None:
+            weights = weights.ravel()
+        label_counts = np.bincount((closest_y + offsets).ravel(),
+                                   weights=weights,
+                                   minlength=num_test * num_classes)
+        label_counts = label_counts.reshape(num_test, num_classes)
+
+        # np.argmax returns the first maximum, i.e. the smallest label on ties.
+        return np.argmax(label_counts, axis=1)
+
+    def cross_validate(self, X, y, k_choices, num_folds=5, weighted=False,
+                       metric='l2'):
+        """
+        Run num_folds-fold cross-validation over every k in k_choices.
+
+        The neighbor ordering of each held-out fold is computed only once, for
+        the largest k, and every smaller k is answered from that ordering, so
+        the distance work is proportional to the number of folds rather than
+        to folds times len(k_choices).
+
+        Inputs:
+        - X: A numpy array of shape (num_train, D) containing training data.
+        - y: A numpy array of shape (num_train,) containing training labels.
+        - k_choices: A list of values of k to evaluate.
+        - num_folds: Number of folds to split the data into.
+        - weighted: If True, weight each vote by the inverse neighbor distance.
+        - metric: One of 'l2', 'l1' or 'cosine'.
+
+        Returns:
+        - k_to_accuracies: A dictionary mapping each k to a list of num_folds
+            accuracies, one per held-out fold.
+        """
+        X_folds = np.array_split(X, num_folds)
+        y_folds = np.array_split(y, num_folds)
+        k_max = max(k_choices)
+        k_to_accuracies = {k: [] for k in k_choices}
+
+        for fold in range(num_folds):
+            X_holdout = X_folds[fold]
+            y_holdout = y_folds[fold]
+            X_rest = np.concatenate(X_folds[:fold] + X_folds[fold + 1:])
+            y_rest = np.concatenate(y_folds[:fold] + y_folds[fold + 1:])
+
+            # Use a copy so the fold's training set does not replace our own,
+            # while keeping the same configuration (memory budget etc.).
+            # Folds are always scored with the exact search.
+            fold_classifier = self._unfitted_copy()
+            fold_classifier.train(X_rest, y_rest)
+            try:
+                nearest_dists, nearest_idx = fold_classifier.compute_k_nearest(
+                    X_holdout, k=k_max, metric=metric)
+            finally:
+                # The fold's training data is not needed any more, so do not
+                # let close() copy it out of shared memory.
+                fold_classifier.X_train = fold_classifier.train_sq_norms = None
+                fold_classifier.close()
+            nearest_y = y_rest[nearest_idx]
+
+            for k in k_choices:
+                weights = None
+                if weighted:
+                    weights = _inverse_distance(nearest_dists[:, :k])
+                y_pred = fold_classifier.vote(nearest_y[:, :k], weights=weights)
+                k_to_accuracies[k].append(np.mean(y_pred == y_holdout))
+
+        return k_to_accuracies
+
+    def predict_labels(self, dists, k=1, weighted=False):
         """
         Given a matrix of distances between test points and training points,
         predict a label for each test point.
@@ -161,58 +620,159 @@ class KNearestNeighbor(object):
         Inputs:
         - dists: A numpy array of shape (num_test, num_train) where dists[i, j]
         gives the distance betwen the ith test point and the jth training point.
+        - k: The number of nearest neighbors that vote for the predicted labels.
+        - weighted: If True, weight each vote by the inverse neighbor distance.
 
         Returns:
         - y: A numpy array of shape (num_test,) containing predicted labels for the
         test data, where y[i] is the predicted label for the test point X[i].
         """
-        num_test = dists.shape[0]
-        y_pred = np.zeros(num_test)
+        #########################################################################
+        # TO-DO:                                                                #
+        # Use the distance matrix to find the k nearest neighbors of the ith    #
+        # testing point, and use self.y_train to find the labels of these       #
+        # neighbors. Store these labels in closest_y.                           #
+        # Hint: Look up the function numpy.argsort.                             #
+        #########################################################################
 
-        for i in range(num_test):
-            # A list of length k storing the labels of the k nearest neighbors to
-            # the ith test point.
-            closest_y = []
-
-            #########################################################################
-            # TO-DO:                                                                #
-            # Use the distance matrix to find the k nearest neighbors of the ith    #
-            # testing point, and use self.y_train to find the labels of these       #
-            # neighbors. Store these labels in closest_y.                           #
-            # Hint: Look up the function numpy.argsort.                             #
-            #########################################################################
-
-            # np.argsort returns an array containing the indices of the items sorted in
-            #   ascending order. This means that for test sample i (i.e. dists[i, :])
-            #   we simply need to sort the distances of each training sample with test
-            #   sample i and choose k from the front (hence [:k]).
-            #
-            # https://docs.scipy.org/doc/numpy/reference/generated/numpy.argsort.html
-
-            k_nearest = np.argsort(dists[i, :])[:k]
-            closest_y = [self.y_train[idx] for idx in k_nearest]
-
-            #########################################################################
-            # TO-DO:                                                                #
-            # Now that you have found the labels of the k nearest neighbors, you    #
-            # need to find the most common label in the list closest_y of labels.   #
-            # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-            # label.                                                                #
-            #########################################################################
-
-            # np.bincount counts the number of occurrences of each value in an array.
-            #   Using this functionality, we can simply count how many times each label
-            #   appears in our closest_y array and then choose the one that appears the
-            #   most frequently with np.argmax.
-            #
-            # https://docs.scipy.org/doc/numpy/reference/generated/numpy.argmax.html
-            # https://docs.scipy.org/doc/numpy/reference/generated/numpy.bincount.html
+        # Rather than fully sorting every row with np.argsort, partially select
+        #   the k smallest distances of all rows at once with np.argpartition
+        #   and only sort those k.
+        #
+        # https://docs.scipy.org/doc/numpy/reference/generated/numpy.argpartition.html
+
+        k = min(k, dists.shape[1])
+        nearest_dists, k_nearest = _smallest_k(dists, k)
+        closest_y = self.y_train[k_nearest] # (num_test, k)
 
-            label_counts = np.bincount(closest_y)
-            y_pred[i] = np.argmax(label_counts)
+        #########################################################################
+        # TO-DO:                                                                #
+        # Now that you have found the labels of the k nearest neighbors, you    #
+        # need to find the most common label in the list closest_y of labels.   #
+        # Store this label in y_pred[i]. Break ties by choosing the smaller     #
+        # label.                                                                #
+        #########################################################################
 
-            #########################################################################
-            #                           END OF YOUR CODE                            # 
-            #########################################################################
+        # np.bincount counts the number of occurrences of each value in an array.
+        #   vote() offsets each row's labels so one bincount covers every test
+        #   point, then chooses the most frequent label with np.argmax.
+        #
+        # https://docs.scipy.org/doc/numpy/reference/generated/numpy.argmax.html
+        # https://docs.scipy.org/doc/numpy/reference/generated/numpy.bincount.html
+
+        weights = _inverse_distance(nearest_dists) if weighted else None
+        y_pred = self.vote(closest_y, weights=weights)
+
+        #########################################################################
+        #                           END OF YOUR CODE                            #
+        #########################################################################
 
         return y_pred
+
+
+def _row_sq_norms(X, block_size=4096):
+    """
+    Squared l2 norm of every row of X, computed in float64 a block of rows at
+    a time so that compact (e.g. uint8 or memory-mapped) data is never
+    converted in full.
+    """
+    norms = np.empty(X.shape[0])
+    for i in range(0, X.shape[0], block_size):
+        block = X[i:i + block_size].astype(np.float64)
+        norms[i:i + block_size] = np.sum(np.square(block), axis=1)
+    return norms
+
+
+def _safe_norms(sq_norms):
+    """ l2 norms from squared norms, with zero norms replaced by one. """
+    norms = np.sqrt(sq_norms)
+    norms[norms == 0] = 1
+    return norms
+
+
+# Per-process state of the sharded search workers, set by _init_shard_worker.
+_shard_state = {}
+
+
+def _init_shard_worker(template, specs):
+    """ Attach a worker process to the shared training data. """
+    blocks, arrays = zip(*[attach_shared_memory(spec) for spec in specs])
+    _shard_state['blocks'] = blocks
+    _shard_state['template'] = template
+    _shard_state['X_train'], _shard_state['train_sq_norms'] = arrays
+
+
+# Shared memory blocks of garbage collected classifiers that could not be
+# closed yet, see _release_workers.
+_blocks_in_use = []
+
+
+def _release_workers(pool, blocks):
+    """ Stop a worker pool and free the shared memory blocks it used. """
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for block in blocks:
+        block.unlink()
+    # A classifier that is garbage collected without close() still holds its
+    # training data when this runs, so its blocks cannot be closed yet; keep
+    # them and try again on the next call.
+    blocks = _blocks_in_use + list(blocks)
+    del _blocks_in_use[:]
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            _blocks_in_use.append(block)
+
+
+def _search_shard(task):
+    """ Find the top-k candidates of one shard of the training set. """
+    start, stop, k, metric, query_spec = task
+    shard = copy.copy(_shard_state['template'])
+    shard.X_train = _shard_state['X_train'][start:stop]
+    shard.train_sq_norms = _shard_state['train_sq_norms'][start:stop]
+    block, X = attach_shared_memory(query_spec)
+    try:
+        nearest_dists, nearest_idx = shard.compute_k_nearest(X, k=k,
+                                                             metric=metric)
+    finally:
+        # The block can only be closed once no array uses its buffer.
+        del X
+        block.close()
+    return nearest_dists, nearest_idx + start
+
+
+def _inverse_distance(dists, eps=1e-8):
+    """ Turn neighbor distances into vote weights; closer neighbors count more. """
+    return 1.0 / (dists + eps)
+
+
+def _smallest_k(values, k, indices=None):
+    """
+    Select the k smallest entries of each row of values, sorted ascending.
+
+    Inputs:
+    - values: A numpy array of shape (N, M).
+    - k: Number of entries to keep per row; must satisfy k <= M.
+    - indices: Optional array of shape (N, M) giving the label to report for
+        each entry of values. Defaults to the column index.
+
+    Returns a tuple of:
+    - top_values: A numpy array of shape (N, k).
+    - top_indices: A numpy array of shape (N, k).
+    """
+    rows = np.arange(values.shape[0])[:, np.newaxis]
+    if k < values.shape[1]:
+        # A partial selection is O(M) per row rather than O(M log M).
+        cols = np.argpartition(values, k - 1, axis=1)[:, :k]
+    else:
+        cols = np.tile(np.arange(values.shape[1]), (values.shape[0], 1))
+    top_values = values[rows, cols]
+
+    order = np.argsort(top_values, axis=1)
+    cols = cols[rows, order]
+    top_values = top_values[rows, order]
+    if indices is None:
+        return top_values, cols
+    return top_values, indices[rows, cols]
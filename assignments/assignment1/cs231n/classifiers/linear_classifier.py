@@ -1,6 +1,11 @@
 from __future__ import print_function
 
+import threading
+
 import numpy as np
+from scipy import sparse
+from six.moves import queue
+from cs231n import optim
 from cs231n.classifiers.linear_svm import *
 from cs231n.classifiers.softmax import *
 from past.builtins import xrange
@@ -12,29 +17,89 @@ class LinearClassifier(object):
     self.W = None
 
   def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, sampling=None, seed=None,
+            dtype=None, update_rule='sgd', optim_config=None,
+            lr_schedule='constant', schedule_config=None, X_val=None,
+            y_val=None, check_every=100, patience=None, chunk_size=10000,
+            num_classes=None):
     """
     Train this linear classifier using stochastic gradient descent.
 
     Inputs:
     - X: A numpy array of shape (N, D) containing training data; there are N
-      training samples each of dimension D.
+      training samples each of dimension D. May also be a scipy.sparse CSR
+      matrix, in which case time and memory scale with its nonzeros. For data
+      that does not fit in memory, X may be the path of a .npy file or an
+      np.memmap, which are streamed from disk, or a chunk source: an iterable
+      of (X_chunk, y_chunk) pairs, or a function returning such an iterable
+      (called once per pass, so that training can make several passes).
     - y: A numpy array of shape (N,) containing training labels; y[i] = c
-      means that X[i] has label 0 <= c < C for C classes.
+      means that X[i] has label 0 <= c < C for C classes. Ignored for chunk
+      sources.
     - learning_rate: (float) learning rate for optimization.
     - reg: (float) regularization strength.
     - num_iters: (integer) number of steps to take when optimizing
     - batch_size: (integer) number of training examples to use at each step.
     - verbose: (boolean) If true, print progress during optimization.
+    - sampling: (string) How minibatches are drawn; see minibatches(). By
+      default 'stream' for memory-mapped data and chunk sources, and 'random'
+      otherwise.
+    - seed: (integer) If not None, seed for the initial weights and the
+      minibatch sampling, making training reproducible.
+    - dtype: If not None, numpy datatype (e.g. np.float32) of the weights and
+      minibatches, and so of the whole loss computation.
+    - update_rule: (string) Name of an update rule in optim.py, e.g. 'sgd',
+      'sgd_momentum', 'nesterov_momentum' or 'adam'.
+    - optim_config: Dictionary of extra hyperparameters for the update rule
+      (momentum, beta1, ...); the learning rate comes from learning_rate.
+    - lr_schedule: (string) 'constant', 'step' or 'cosine'; selects the
+      matching *_schedule function in optim.py.
+    - schedule_config: Dictionary of hyperparameters for the schedule.
+    - X_val, y_val: Optional held-out data. If given, validation accuracy is
+      checked every check_every iterations and W is reset to the weights with
+      the best validation accuracy at the end of training.
+    - check_every: (integer) iterations between validation checks.
+    - patience: (integer) If not None, stop early once this many validation
+      checks in a row have not improved on the best accuracy.
+    - chunk_size: (integer) rows per chunk read from disk for 'stream'.
+    - num_classes: (integer) number of classes; only needed to initialize W
+      when training from a chunk source.
 
     Outputs:
     A list containing the value of the loss function at each training iteration.
     """
-    num_train, dim = X.shape
-    num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
-    if self.W is None:
+    if isinstance(X, str):
+      X = np.load(X, mmap_mode='r')
+    if sampling is None:
+      out_of_core = isinstance(X, np.memmap) or not hasattr(X, 'shape')
+      sampling = 'stream' if out_of_core else 'random'
+    rng = np.random if seed is None else np.random.RandomState(seed)
+
+    if self.W is None and hasattr(X, 'shape'):
       # lazily initialize W
-      self.W = 0.001 * np.random.randn(dim, num_classes)
+      num_train, dim = X.shape
+      num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
+      self.W = 0.001 * rng.randn(dim, num_classes)
+    elif self.W is None and num_classes is None:
+      raise ValueError('num_classes is required to train from chunks')
+    if self.W is not None and dtype is not None:
+      self.W = self.W.astype(dtype, copy=False)
+
+    batches = minibatches(X, y, batch_size, sampling=sampling, rng=rng,
+                          dtype=dtype, chunk_size=chunk_size)
+    loss_fn = self.fused_loss()
+
+    if not hasattr(optim, update_rule):
+      raise ValueError('Invalid update_rule "%s"' % update_rule)
+    if not hasattr(optim, '%s_schedule' % lr_schedule):
+      raise ValueError('Invalid lr_schedule "%s"' % lr_schedule)
+    update = getattr(optim, update_rule)
+    schedule = getattr(optim, '%s_schedule' % lr_schedule)
+    config = dict(optim_config or {})
+
+    best_val_acc = -1
+    best_W = None
+    checks_without_improvement = 0
 
     # Run stochastic gradient descent to optimize W
     loss_history = []
@@ -53,17 +118,27 @@ class LinearClassifier(object):
       # Hint: Use np.random.choice to generate indices. Sampling with         #
       # replacement is faster than sampling without replacement.              #
       #########################################################################
-      
-      batch_indices = np.random.choice(num_train, batch_size, replace=True)
-      X_batch = X[batch_indices]
-      y_batch = y[batch_indices]
+
+      try:
+        X_batch, y_batch = next(batches)
+      except StopIteration:
+        break # A single-pass chunk source has run out of data.
+
+      if self.W is None:
+        # Training from chunks: the dimension is only known now.
+        self.W = 0.001 * rng.randn(X_batch.shape[1], num_classes)
+        if dtype is not None:
+          self.W = self.W.astype(dtype, copy=False)
 
       #########################################################################
       #                       END OF YOUR CODE                                #
       #########################################################################
 
       # evaluate loss and gradient
-      loss, grad = self.loss(X_batch, y_batch, reg)
+      if loss_fn is None:
+        loss, grad = self.loss(X_batch, y_batch, reg)
+      else:
+        loss, grad = loss_fn(self.W, X_batch, y_batch, reg)
       loss_history.append(loss)
 
       # perform parameter update
@@ -72,7 +147,10 @@ class LinearClassifier(object):
       # Update the weights using the gradient and the learning rate.          #
       #########################################################################
       
-      self.W = self.W - (learning_rate * grad)
+      # The update rules in optim.py modify W in place.
+      config['learning_rate'] = schedule(learning_rate, it, num_iters,
+                                         schedule_config)
+      self.W, config = update(self.W, grad, config)
 
       #########################################################################
       #                       END OF YOUR CODE                                #
@@ -81,16 +159,129 @@ class LinearClassifier(object):
       if verbose and it % 100 == 0:
         print('iteration %d / %d: loss %f' % (it, num_iters, loss))
 
+      # Keep track of the best weights on the held-out data.
+      if X_val is not None and ((it + 1) % check_every == 0 or
+                                it == num_iters - 1):
+        val_acc = np.mean(self.predict(X_val) == y_val)
+        if val_acc > best_val_acc:
+          best_val_acc = val_acc
+          best_W = self.W.copy()
+          checks_without_improvement = 0
+        else:
+          checks_without_improvement += 1
+        if verbose:
+          print('iteration %d / %d: val acc %f' % (it, num_iters, val_acc))
+        if patience is not None and checks_without_improvement >= patience:
+          if verbose:
+            print('Stopping early at iteration %d' % it)
+          break
+
+    # Stop any background reader.
+    batches.close()
+
+    if best_W is not None:
+      self.W = best_W
+
     return loss_history
 
+  def train_grid(self, X, y, learning_rates, regs, num_iters=100,
+                 batch_size=200, verbose=False, sampling=None, seed=None,
+                 dtype=None, chunk_size=10000):
+    """
+    Train one classifier for every (learning_rate, reg) pair of a grid at the
+    same time. All weight matrices are kept in a single (D, P, C) stack and
+    see the same minibatches, so each step runs two matrix multiplies for the
+    whole grid instead of two per configuration, and the minibatches are
+    drawn (and cast) only once. The regularization gradient is applied as a
+    weight decay in the update, which saves two passes over the stack.
+
+    The multiplies still do P times the arithmetic of a single run, so the
+    grid is cheaper than P separate runs by the per-step overheads it shares
+    rather than by a constant factor; it pays off most when those dominate,
+    e.g. for small batches or many classes.
+
+    Every configuration starts from the weights and sees the minibatches
+    that train() uses with the same seed and the default 'sgd' update, so
+    each one follows the trajectory of a separate train() run up to
+    floating point round-off.
+
+    Inputs:
+    - X, y, num_iters, batch_size, verbose, sampling, seed, dtype,
+      chunk_size: Same as for train, except that X must be an array (or the
+      path of a .npy file), not a chunk source.
+    - learning_rates: List of learning rates to try.
+    - regs: List of regularization strengths to try.
+
+    Returns a tuple of:
+    - classifiers: A dictionary mapping each (learning_rate, reg) pair to a
+      trained classifier of the same class as self.
+    - loss_histories: A dictionary mapping each (learning_rate, reg) pair to
+      the list of losses at each training iteration.
+    """
+    if isinstance(X, str):
+      X = np.load(X, mmap_mode='r')
+    if sampling is None:
+      sampling = 'stream' if isinstance(X, np.memmap) else 'random'
+    num_train, dim = X.shape
+    num_classes = np.max(y) + 1
+    grid = [(lr, reg) for lr in learning_rates for reg in regs]
+
+    # Draw the initial weights exactly as train() does, and give all of the
+    # configurations the same start.
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    W0 = 0.001 * rng.randn(dim, num_classes)
+    if dtype is not None:
+      W0 = W0.astype(dtype, copy=False)
+    W = np.empty((dim, len(grid), num_classes), dtype=W0.dtype)
+    W[...] = W0[:, np.newaxis]
+    batches = minibatches(X, y, batch_size, sampling=sampling, rng=rng,
+                          dtype=dtype, chunk_size=chunk_size)
+
+    # W -= lr * (dW + reg * W) is W *= 1 - lr * reg followed by W -= lr * dW.
+    # Both factors are in the datatype of W so float32 stays float32.
+    step_sizes = np.array([lr for lr, _ in grid], dtype=W.dtype)
+    reg_array = np.array([reg for _, reg in grid])
+    decay = (1 - step_sizes * reg_array).astype(W.dtype)
+    step_sizes = step_sizes[:, np.newaxis]
+    decay = decay[:, np.newaxis]
+
+    loss_history = []
+    for it in xrange(num_iters):
+      X_batch, y_batch = next(batches)
+
+      loss, grad = self.stacked_loss(W, X_batch, y_batch, reg_array,
+                                     with_reg_grad=False)
+      loss_history.append(loss)
+
+      grad *= step_sizes
+      W *= decay
+      W -= grad
+
+      if verbose and it % 100 == 0:
+        print('iteration %d / %d: min loss %f' % (it, num_iters, np.min(loss)))
+
+    # Stop any background reader.
+    batches.close()
+
+    loss_history = np.array(loss_history)
+    classifiers = {}
+    loss_histories = {}
+    for p, params in enumerate(grid):
+      classifier = self.__class__()
+      classifier.W = W[:, p].copy()
+      classifiers[params] = classifier
+      loss_histories[params] = list(loss_history[:, p])
+
+    return classifiers, loss_histories
+
   def predict(self, X):
     """
     Use the trained weights of this linear classifier to predict labels for
     data points.
 
     Inputs:
-    - X: A numpy array of shape (N, D) containing training data; there are N
-      training samples each of dimension D.
+    - X: A numpy array or scipy.sparse matrix of shape (N, D) containing
+      training data; there are N training samples each of dimension D.
 
     Returns:
     - y_pred: Predicted labels for the data in X. y_pred is a 1-dimensional
@@ -103,7 +294,7 @@ class LinearClassifier(object):
     # Implement this method. Store the predicted labels in y_pred.            #
     ###########################################################################
     
-    scores = np.dot(X, self.W) # (N, C)
+    scores = X.dot(self.W) # (N, C); also works for sparse X.
     y_pred = np.argmax(scores, axis=1) # Along the rows, get the index of the maximum value.
 
     ###########################################################################
@@ -128,6 +319,199 @@ class LinearClassifier(object):
     """
     pass
 
+  def fused_loss(self):
+    """
+    Return a loss object with reusable workspaces (such as SVMLoss) that
+    train uses instead of loss; it is called as loss_fn(W, X_batch, y_batch,
+    reg) and must compute the same values as loss. Subclasses may override
+    this; the default None makes train call loss.
+    """
+    return None
+
+  def stacked_loss(self, W, X_batch, y_batch, reg, with_reg_grad=True):
+    """
+    Compute the loss function and its derivative for a stack of weight
+    matrices at once; used by train_grid. Subclasses will override this.
+
+    Inputs:
+    - W: A numpy array of shape (D, P, C) holding P weight matrices.
+    - X_batch, y_batch: Same as for loss.
+    - reg: A numpy array of shape (P,) of regularization strengths.
+    - with_reg_grad: If False, leave the regularization term reg * W out of
+      the gradient (but not out of the loss).
+
+    Returns: A tuple containing:
+    - loss as a numpy array of shape (P,)
+    - gradient with respect to W; an array of the same shape as W
+    """
+    pass
+
+
+def minibatches(X, y, batch_size, sampling='random', rng=np.random,
+                dtype=None, chunk_size=10000):
+  """
+  Generate an endless stream of minibatches from (X, y).
+
+  Inputs:
+  - X: A numpy array or scipy.sparse CSR matrix of shape (N, D) containing
+    training data.
+  - y: A numpy array of shape (N,) containing training labels.
+  - batch_size: (integer) number of examples per minibatch.
+  - sampling: (string) Either 'random', which draws every minibatch
+    independently with replacement, or 'epoch', which permutes the data once
+    per epoch into a preallocated buffer and serves consecutive slices of it.
+    With 'epoch' every example is seen once per epoch and each minibatch is a
+    view instead of a freshly gathered copy; the N % batch_size examples left
+    over at the end of an epoch are skipped for that epoch. 'stream' is for
+    data that does not fit in memory: X is read chunk_size rows at a time in
+    a random chunk order by a background thread, which loads the next chunk
+    while minibatches are served from the current one, and each chunk is
+    shuffled in memory. X may then also be a chunk source (see
+    LinearClassifier.train); peak memory is a few chunks.
+  - rng: A numpy.random.RandomState (or the numpy.random module) used to
+    draw the samples. For 'stream', a seed for the background thread is drawn
+    from it and the thread uses its own generator.
+  - dtype: If not None, datatype of the minibatches, e.g. np.float32; for
+    'epoch' this is also the datatype of the shuffled buffer, halving its
+    memory.
+  - chunk_size: (integer) rows per chunk for 'stream'.
+
+  Yields:
+  Tuples (X_batch, y_batch) of shapes (batch_size, D) and (batch_size,).
+  """
+  if sampling == 'stream':
+    # The reader thread gets its own generator, drawn here before it starts,
+    # so that its draws do not interleave with those of the caller.
+    chunk_rng = np.random.RandomState(rng.randint(2**31 - 1))
+    loader = Prefetcher(_load_chunks(X, y, chunk_size, chunk_rng, dtype))
+    try:
+      for X_chunk, y_chunk in loader:
+        chunk_batch_size = min(batch_size, X_chunk.shape[0])
+        for start in xrange(0, X_chunk.shape[0] - chunk_batch_size + 1,
+                            chunk_batch_size):
+          yield (X_chunk[start:start + chunk_batch_size],
+                 y_chunk[start:start + chunk_batch_size])
+    finally:
+      loader.close()
+    return
+
+  num_train = X.shape[0]
+  if sampling == 'random':
+    while True:
+      batch_indices = rng.choice(num_train, batch_size, replace=True)
+      X_batch = X[batch_indices]
+      if dtype is not None:
+        X_batch = X_batch.astype(dtype, copy=False)
+      yield X_batch, y[batch_indices]
+  elif sampling != 'epoch':
+    raise ValueError('Invalid sampling "%s"' % sampling)
+
+  batch_size = min(batch_size, num_train)
+  if not sparse.issparse(X):
+    X_shuffled = np.empty(X.shape, dtype=X.dtype if dtype is None else dtype)
+  while True:
+    order = rng.permutation(num_train)
+    if sparse.issparse(X):
+      # Row slices of a CSR matrix are cheap, so just permute the rows.
+      X_shuffled = sparse.csr_matrix(X)[order]
+      if dtype is not None:
+        X_shuffled = X_shuffled.astype(dtype)
+    else:
+      # Gather in chunks so the only full-size array is the reused buffer.
+      for start in xrange(0, num_train, 4096):
+        X_shuffled[start:start + 4096] = X[order[start:start + 4096]]
+    y_shuffled = y[order]
+    for start in xrange(0, num_train - batch_size + 1, batch_size):
+      yield (X_shuffled[start:start + batch_size],
+             y_shuffled[start:start + batch_size])
+
+
+def _load_chunks(X, y, chunk_size, rng, dtype):
+  """
+  Generate shuffled (X_chunk, y_chunk) pairs from an array or chunk source,
+  pass after pass. For arrays, each pass visits the chunks in random order;
+  a pass that produces no chunks (an exhausted iterator) ends the stream.
+  """
+  while True:
+    if hasattr(X, 'shape'):
+      starts = rng.permutation(np.arange(0, X.shape[0], chunk_size))
+      chunks = ((X[start:start + chunk_size], y[start:start + chunk_size])
+                for start in starts)
+    else:
+      chunks = X() if callable(X) else X
+
+    empty_pass = True
+    for X_chunk, y_chunk in chunks:
+      empty_pass = False
+      # Fancy indexing reads a memory-mapped chunk into memory and shuffles
+      # it in the same copy.
+      order = rng.permutation(X_chunk.shape[0])
+      X_chunk = X_chunk[order]
+      if dtype is not None:
+        X_chunk = X_chunk.astype(dtype, copy=False)
+      yield X_chunk, np.asarray(y_chunk)[order]
+    if empty_pass:
+      return
+
+
+class Prefetcher(object):
+  """
+  Iterate over an iterable in a background thread, keeping up to depth items
+  ready, so that producing the next item (e.g. reading from disk) overlaps
+  with consuming the current one. Exceptions raised by the iterable are
+  re-raised in the consuming thread.
+
+  Example usage:
+
+  for X_chunk, y_chunk in Prefetcher(read_chunks()):
+    ...
+  """
+
+  def __init__(self, iterable, depth=1):
+    self.queue = queue.Queue(maxsize=depth)
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._fill, args=(iterable,))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _fill(self, iterable):
+    try:
+      for item in iterable:
+        if not self._put((True, item)):
+          return
+      self._put((False, None))
+    except Exception as e:
+      self._put((False, e))
+
+  def _put(self, item):
+    # Wake up regularly so that close() can stop a blocked producer.
+    while not self.stopped.is_set():
+      try:
+        self.queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    ok, item = self.queue.get()
+    if ok:
+      return item
+    # Leave the end marker for any later call.
+    self.queue.put((False, item))
+    if item is None:
+      raise StopIteration
+    raise item
+
+  next = __next__
+
+  def close(self):
+    """ Stop the background thread. """
+    self.stopped.set()
+
 
 class LinearSVM(LinearClassifier):
   """ A subclass that uses the Multiclass SVM loss function """
@@ -135,6 +519,12 @@ class LinearSVM(LinearClassifier):
   def loss(self, X_batch, y_batch, reg):
     return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+  def fused_loss(self):
+    return SVMLoss()
+
+  def stacked_loss(self, W, X_batch, y_batch, reg, with_reg_grad=True):
+    return svm_loss_stacked(W, X_batch, y_batch, reg, with_reg_grad)
+
 
 class Softmax(LinearClassifier):
   """ A subclass that uses the Softmax + Cross-entropy loss function """
@@ -142,3 +532,9 @@ class Softmax(LinearClassifier):
   def loss(self, X_batch, y_batch, reg):
     return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+  def fused_loss(self):
+    return SoftmaxLoss()
+
+  def stacked_loss(self, W, X_batch, y_batch, reg, with_reg_grad=True):
+    return softmax_loss_stacked(W, X_batch, y_batch, reg, with_reg_grad)
+
@@ -1,5 +1,6 @@
 import numpy as np
 from random import shuffle
+from scipy import sparse
 
 
 def svm_loss_naive(W, X, y, reg):
@@ -65,7 +66,9 @@ def svm_loss_vectorized(W, X, y, reg):
     """
     Structured SVM loss function, vectorized implementation.
 
-    Inputs and outputs are the same as svm_loss_naive.
+    Inputs and outputs are the same as svm_loss_naive, except that X may also
+    be a scipy.sparse matrix (preferably CSR), in which case the scores and
+    gradient are computed with sparse-dense products.
     """
     loss = 0.0
     dW = np.zeros(W.shape) # initialize the gradient as zero
@@ -78,7 +81,7 @@ def svm_loss_vectorized(W, X, y, reg):
 
     # Calculate scores.
     N = X.shape[0]
-    scores = np.dot(X, W) # (N, D) x (D, C) = (N, C)
+    scores = X.dot(W) # (N, D) x (D, C) = (N, C)
     correct_class_score = scores[np.arange(N), y] # Select correct indices y from each training sample row. (N,)
     correct_class_score = correct_class_score[:, np.newaxis] # (N, 1)
 
@@ -110,7 +113,7 @@ def svm_loss_vectorized(W, X, y, reg):
 
     new_margins[np.arange(N), y] -= sums # (N, C) - (N,)
 
-    dW = np.dot(X.T, new_margins) # (D, N) x (N, C) = (D, C)
+    dW = X.T.dot(new_margins) # (D, N) x (N, C) = (D, C)
 
     dW /= N
     dW += reg * W 
@@ -120,3 +123,136 @@ def svm_loss_vectorized(W, X, y, reg):
     #############################################################################
 
     return loss, dW
+
+
+def svm_loss_stacked(W, X, y, reg, with_reg_grad=True):
+    """
+    Structured SVM loss function for a stack of P weight matrices evaluated on
+    the same minibatch, vectorized across the stack.
+
+    The stack is laid out so that W.reshape(D, P * C) is a single weight
+    matrix; all P score matrices then come out of one matrix multiply, and all
+    P gradients out of one more.
+
+    Inputs:
+    - W: A numpy array of shape (D, P, C) containing P weight matrices.
+    - X: A numpy array or scipy.sparse matrix of shape (N, D) containing a
+      minibatch of data.
+    - y: A numpy array of shape (N,) containing training labels.
+    - reg: A numpy array of shape (P,) giving the regularization strength of
+      each weight matrix.
+    - with_reg_grad: If False, the returned gradient leaves out the
+      regularization term reg * W, for callers that apply it as a weight
+      decay in their update instead; the loss always includes it.
+
+    Returns a tuple of:
+    - loss: A numpy array of shape (P,) with the loss of each weight matrix
+    - gradient with respect to W; an array of shape (D, P, C)
+    """
+    D, P, C = W.shape
+    N = X.shape[0]
+    rows = np.arange(N)
+
+    scores = X.dot(W.reshape(D, P * C)).reshape(N, P, C)
+    correct_class_score = scores[rows, :, y] # (N, P)
+
+    margins = scores - correct_class_score[:, :, np.newaxis] + 1
+    np.maximum(margins, 0, out=margins)
+    margins[rows, :, y] = 0
+
+    # The einsum sums W * W without building it.
+    loss = np.sum(margins, axis=(0, 2)) / N
+    loss += reg * np.einsum('dpc,dpc->p', W, W)
+
+    # Same gradient as svm_loss_vectorized, one (N, C) block per matrix. The
+    # 1 / N is applied to the small (N, P, C) mask rather than to dW.
+    mask = (margins > 0).astype(W.dtype)
+    mask[rows, :, y] = -np.sum(mask, axis=2)
+    mask /= N
+    dW = X.T.dot(mask.reshape(N, P * C)).reshape(D, P, C)
+    if with_reg_grad:
+        dW += reg.astype(W.dtype)[:, np.newaxis] * W
+
+    return loss, dW
+
+
+class SVMLoss(object):
+    """
+    Structured SVM loss with reusable workspaces.
+
+    Computes the same loss and gradient as svm_loss_vectorized, but keeps the
+    (N, C) and (D, C) intermediates between calls and updates them in place,
+    so a training loop with a fixed batch size allocates no new arrays after
+    the first call. Everything is computed in the datatype of W, so float32
+    weights give a float32 computation.
+
+    The returned gradient is one of the workspaces: it is overwritten by the
+    next call, so consume (or copy) it first.
+
+    X may be a scipy.sparse matrix; the two matrix products then go through
+    sparse-dense products, which cost one temporary each.
+
+    Example usage:
+
+    loss_fn = SVMLoss()
+    loss, dW = loss_fn(W, X_batch, y_batch, reg)
+    """
+
+    def __init__(self):
+        self.shape = None
+
+    def _allocate(self, N, D, C, dtype):
+        self.shape = (N, D, C, dtype)
+        self.scores = np.empty((N, C), dtype=dtype)
+        self.mask = np.empty((N, C), dtype=dtype)
+        self.row_values = np.empty(N, dtype=dtype)
+        self.flat_idx = np.empty(N, dtype=np.intp)
+        self.rows = np.arange(N) * C
+        self.dW = np.empty((D, C), dtype=dtype)
+        self.reg_grad = np.empty((D, C), dtype=dtype)
+
+    def __call__(self, W, X, y, reg):
+        """
+        Inputs and outputs are the same as svm_loss_naive.
+        """
+        N, D = X.shape
+        C = W.shape[1]
+        if self.shape != (N, D, C, W.dtype):
+            self._allocate(N, D, C, W.dtype)
+        X = X.astype(W.dtype, copy=False)
+        scores, mask, flat_idx = self.scores, self.mask, self.flat_idx
+
+        # Flat indices of the correct classes in the (N, C) workspaces.
+        np.add(self.rows, y, out=flat_idx)
+
+        # margins = max(0, scores - correct_class_score + 1), built in scores.
+        if sparse.issparse(X):
+            scores[...] = X.dot(W)
+        else:
+            np.dot(X, W, out=scores)
+        np.take(scores, flat_idx, out=self.row_values)
+        scores -= self.row_values[:, np.newaxis]
+        scores += 1
+        np.maximum(scores, 0, out=scores)
+        np.put(scores, flat_idx, 0)
+
+        loss = np.sum(scores) / N
+        loss += reg * np.vdot(W, W)
+
+        # Each positive margin adds X[i] to its class and subtracts it from
+        # the correct class.
+        np.greater(scores, 0, out=mask)
+        np.sum(mask, axis=1, out=self.row_values)
+        np.negative(self.row_values, out=self.row_values)
+        np.put(mask, flat_idx, self.row_values)
+
+        dW = self.dW
+        if sparse.issparse(X):
+            dW[...] = X.T.dot(mask)
+        else:
+            np.dot(X.T, mask, out=dW)
+        dW /= N
+        np.multiply(W, reg, out=self.reg_grad)
+        dW += self.reg_grad
+
+        return loss, dW
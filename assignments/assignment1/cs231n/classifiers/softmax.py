@@ -1,6 +1,7 @@
 import numpy as np
 from random import shuffle
 from past.builtins import xrange
+from scipy import sparse
 
 def softmax_loss_naive(W, X, y, reg):
   """
@@ -78,7 +79,9 @@ def softmax_loss_vectorized(W, X, y, reg):
   """
   Softmax loss function, vectorized version.
 
-  Inputs and outputs are the same as softmax_loss_naive.
+  Inputs and outputs are the same as softmax_loss_naive, except that X may
+  also be a scipy.sparse matrix (preferably CSR), in which case the scores and
+  gradient are computed with sparse-dense products.
   """
   # Initialize the loss and gradient to zero.
   loss = 0.0
@@ -95,7 +98,7 @@ def softmax_loss_vectorized(W, X, y, reg):
   C = W.shape[1]
   D = W.shape[0]
 
-  scores = np.dot(X, W) # (N, C)
+  scores = X.dot(W) # (N, C)
   output = np.exp(scores)
 
   normalizer = np.sum(output, axis=1, keepdims=True) # Summed exponents.
@@ -108,7 +111,7 @@ def softmax_loss_vectorized(W, X, y, reg):
   
   # Compute gradient.
   output[np.arange(N), y] -= 1   # (N, C)
-  dW += np.dot(X.T, output)
+  dW += X.T.dot(output)
 
   # add reg term
   dW /= N
@@ -120,3 +123,122 @@ def softmax_loss_vectorized(W, X, y, reg):
 
   return loss, dW
 
+
+
+def softmax_loss_stacked(W, X, y, reg, with_reg_grad=True):
+  """
+  Softmax loss function for a stack of P weight matrices evaluated on the
+  same minibatch, vectorized across the stack.
+
+  Inputs:
+  - W: A numpy array of shape (D, P, C) containing P weight matrices.
+  - X: A numpy array or scipy.sparse matrix of shape (N, D) containing a
+    minibatch of data.
+  - y: A numpy array of shape (N,) containing training labels.
+  - reg: A numpy array of shape (P,) giving the regularization strength of
+    each weight matrix.
+  - with_reg_grad: If False, the returned gradient leaves out the
+    regularization term reg * W; see svm_loss_stacked.
+
+  Returns a tuple of:
+  - loss: A numpy array of shape (P,) with the loss of each weight matrix
+  - gradient with respect to W; an array of shape (D, P, C)
+  """
+  D, P, C = W.shape
+  N = X.shape[0]
+  rows = np.arange(N)
+
+  # W.reshape(D, P * C) is one wide weight matrix, so a single matrix
+  # multiply produces the scores of every matrix in the stack.
+  scores = X.dot(W.reshape(D, P * C)).reshape(N, P, C)
+  scores -= np.max(scores, axis=2, keepdims=True) # For numeric stability.
+  output = np.exp(scores)
+  output /= np.sum(output, axis=2, keepdims=True)
+
+  loss = -np.sum(np.log(output[rows, :, y]), axis=0) / N
+  loss += reg * np.einsum('dpc,dpc->p', W, W)
+
+  output[rows, :, y] -= 1
+  output /= N # Cheaper on the (N, P, C) output than on dW.
+  dW = X.T.dot(output.reshape(N, P * C)).reshape(D, P, C)
+  if with_reg_grad:
+    dW += reg.astype(W.dtype)[:, np.newaxis] * W
+
+  return loss, dW
+
+
+class SoftmaxLoss(object):
+  """
+  Softmax loss with reusable workspaces.
+
+  Computes the same loss and gradient as softmax_loss_vectorized, but keeps
+  the (N, C) and (D, C) intermediates between calls and updates them in
+  place, so a training loop with a fixed batch size allocates no new arrays
+  after the first call. Everything is computed in the datatype of W, so
+  float32 weights give a float32 computation.
+
+  The returned gradient is one of the workspaces: it is overwritten by the
+  next call, so consume (or copy) it first.
+
+  X may be a scipy.sparse matrix; the two matrix products then go through
+  sparse-dense products, which cost one temporary each.
+  """
+
+  def __init__(self):
+    self.shape = None
+
+  def _allocate(self, N, D, C, dtype):
+    self.shape = (N, D, C, dtype)
+    self.scores = np.empty((N, C), dtype=dtype)
+    self.row_values = np.empty(N, dtype=dtype)
+    self.flat_idx = np.empty(N, dtype=np.intp)
+    self.rows = np.arange(N) * C
+    self.dW = np.empty((D, C), dtype=dtype)
+    self.reg_grad = np.empty((D, C), dtype=dtype)
+
+  def __call__(self, W, X, y, reg):
+    """
+    Inputs and outputs are the same as softmax_loss_naive.
+    """
+    N, D = X.shape
+    C = W.shape[1]
+    if self.shape != (N, D, C, W.dtype):
+      self._allocate(N, D, C, W.dtype)
+    X = X.astype(W.dtype, copy=False)
+    output, row_values, flat_idx = self.scores, self.row_values, self.flat_idx
+
+    # Flat indices of the correct classes in the (N, C) workspaces.
+    np.add(self.rows, y, out=flat_idx)
+
+    # Class probabilities, shifted by the row maximum for numeric stability.
+    if sparse.issparse(X):
+      output[...] = X.dot(W)
+    else:
+      np.dot(X, W, out=output)
+    np.max(output, axis=1, out=row_values)
+    output -= row_values[:, np.newaxis]
+    np.exp(output, out=output)
+    np.sum(output, axis=1, out=row_values)
+    output /= row_values[:, np.newaxis]
+
+    # Compute loss.
+    np.take(output, flat_idx, out=row_values)
+    np.log(row_values, out=row_values)
+    loss = -np.sum(row_values) / N
+    loss += reg * np.vdot(W, W)
+
+    # Compute gradient: subtract 1 from the correct class probabilities.
+    np.take(output, flat_idx, out=row_values)
+    row_values -= 1
+    np.put(output, flat_idx, row_values)
+
+    dW = self.dW
+    if sparse.issparse(X):
+      dW[...] = X.T.dot(output)
+    else:
+      np.dot(X.T, output, out=dW)
+    dW /= N
+    np.multiply(W, reg, out=self.reg_grad)
+    dW += self.reg_grad
+
+    return loss, dW
@@ -2,7 +2,9 @@ from __future__ import print_function
 
 from six.moves import cPickle as pickle
 import numpy as np
+import multiprocessing
 import os
+import tempfile
 from scipy.misc import imread
 import platform
 
@@ -16,66 +18,255 @@ def load_pickle(f):
     raise ValueError("invalid python version: {}".format(version))
 
 
-def load_CIFAR_batch(filename):
-    """ load single batch of cifar """
+def load_CIFAR_batch(filename, dtype="float"):
+    """
+    load single batch of cifar; with dtype=None the pixels are kept as uint8
+    """
     with open(filename, mode='rb') as f:
         datadict = load_pickle(f)
         X = datadict['data'] # Originally (10000, 3072)
         Y = datadict['labels']
-        X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype("float")
+        X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1)
+        if dtype is not None:
+            X = X.astype(dtype)
         Y = np.array(Y)
         return X, Y
 
 
-def load_CIFAR10(ROOT):
+def load_CIFAR10(ROOT, dtype="float"):
     """ load all of cifar """
     xs = []
     ys = []
     for b in range(1,6):
         f = os.path.join(ROOT, 'data_batch_%d' % (b, ))
-        X, Y = load_CIFAR_batch(f)
+        X, Y = load_CIFAR_batch(f, dtype=dtype)
         xs.append(X)
         ys.append(Y)    
     Xtr = np.concatenate(xs)
     Ytr = np.concatenate(ys)
     del X, Y
-    Xte, Yte = load_CIFAR_batch(os.path.join(ROOT, 'test_batch'))
+    Xte, Yte = load_CIFAR_batch(os.path.join(ROOT, 'test_batch'), dtype=dtype)
     return Xtr, Ytr, Xte, Yte
 
 
+def convert_CIFAR10(ROOT, cache_dir=None):
+    """
+    Convert the pickled CIFAR-10 batches in ROOT once into uint8 .npy files
+    that load_CIFAR10_mmap can memory-map. The images are written both in the
+    (N, 32, 32, 3) layout returned by load_CIFAR10 and in the (N, 3, 32, 32)
+    layout used by the networks, so neither needs a transpose at load time.
+
+    Inputs:
+    - ROOT: Directory holding the pickled CIFAR-10 batches.
+    - cache_dir: Directory for the converted files; defaults to ROOT/uint8.
+
+    Returns the cache directory.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(ROOT, 'uint8')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    Xtr, Ytr, Xte, Yte = load_CIFAR10(ROOT, dtype=None)
+    for split, X, Y in (('train', Xtr, Ytr), ('test', Xte, Yte)):
+        _save_atomic(_cifar_cache_path(cache_dir, 'y', split), Y)
+        _save_atomic(_cifar_cache_path(cache_dir, 'X', split, 'NCHW'),
+                     X.transpose(0, 3, 1, 2))
+        # Written last, so its presence means the conversion has finished.
+        _save_atomic(_cifar_cache_path(cache_dir, 'X', split, 'NHWC'), X)
+    return cache_dir
+
+
+def load_CIFAR10_mmap(ROOT, layout='NHWC', dtype=None, cache_dir=None):
+    """
+    Load CIFAR-10 by memory-mapping the uint8 files written by
+    convert_CIFAR10, converting them first if needed. Only the pages that are
+    actually read are brought into memory, so startup is near-instant.
+
+    Inputs:
+    - ROOT: Directory holding the pickled CIFAR-10 batches.
+    - layout: 'NHWC' for (N, 32, 32, 3) images as returned by load_CIFAR10,
+      or 'NCHW' for (N, 3, 32, 32) images.
+    - dtype: If None, the images are returned as read-only uint8 memmaps.
+      Otherwise they are wrapped in a LazyFloatArray that converts to this
+      dtype only the images that are indexed, e.g. one minibatch at a time.
+    - cache_dir: Directory of the converted files; defaults to ROOT/uint8.
+
+    Returns Xtr, Ytr, Xte, Yte like load_CIFAR10.
+    """
+    if layout not in ('NHWC', 'NCHW'):
+        raise ValueError('Unrecognized layout "%s"' % layout)
+    if cache_dir is None:
+        cache_dir = os.path.join(ROOT, 'uint8')
+    if not all(os.path.isfile(_cifar_cache_path(cache_dir, 'X', split, 'NHWC'))
+               for split in ('train', 'test')):
+        convert_CIFAR10(ROOT, cache_dir)
+
+    data = []
+    for split in ('train', 'test'):
+        X = np.load(_cifar_cache_path(cache_dir, 'X', split, layout),
+                    mmap_mode='r')
+        if dtype is not None:
+            X = LazyFloatArray(X, dtype)
+        Y = np.load(_cifar_cache_path(cache_dir, 'y', split), mmap_mode='r')
+        data.extend([X, Y])
+    return tuple(data)
+
+
+def _cached_mean_image(path, X, num_images, chunk_size=10000):
+    """
+    Mean of the first num_images images of the uint8 array X, accumulated in
+    float64 a chunk at a time and cached as the .npy file path.
+    """
+    if os.path.isfile(path):
+        return np.load(path)
+
+    total = np.zeros(X.shape[1:])
+    for start in range(0, num_images, chunk_size):
+        stop = min(start + chunk_size, num_images)
+        total += np.sum(X[start:stop], axis=0, dtype=np.float64)
+    mean_image = total / num_images
+    _save_atomic(path, mean_image)
+    return mean_image
+
+
+def _preprocess_images(X, dtype, mean_image=None, chunk_size=10000):
+    """
+    Convert the integer images X to dtype and subtract mean_image, a chunk at
+    a time, writing straight into the single output array.
+    """
+    out = np.empty(X.shape, dtype=dtype)
+    for start in range(0, X.shape[0], chunk_size):
+        chunk = out[start:start + chunk_size]
+        chunk[...] = X[start:start + chunk_size]
+        if mean_image is not None:
+            chunk -= mean_image
+    return out
+
+
+class LazyFloatArray(object):
+    """
+    A read-only view of an integer image array (such as a uint8 memmap) that
+    converts to floating point only the images that are indexed. Indexing it
+    like a numpy array, e.g. X[batch_mask] or X[start:stop], returns a new
+    array of the requested dtype, so the full float copy of the dataset is
+    never built unless np.asarray is called on the whole view.
+
+    If mean is given, it is subtracted from every image as it is converted.
+    """
+
+    def __init__(self, array, dtype=np.float64, mean=None):
+        self.array = array
+        self.dtype = np.dtype(dtype)
+        self.mean = mean
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            # Convert whole images first so the mean lines up, then apply the
+            # rest of the index.
+            images = self[index[0]]
+            if images.ndim < self.array.ndim:
+                return images[index[1:]]
+            return images[(slice(None),) + index[1:]]
+        images = np.array(self.array[index], dtype=self.dtype)
+        if self.mean is not None:
+            images -= self.mean
+        return images
+
+    def __array__(self, dtype=None, copy=None):
+        images = _preprocess_images(self.array, self.dtype, self.mean)
+        if dtype is not None:
+            images = images.astype(dtype, copy=False)
+        return images
+
+
+def _cifar_cache_path(cache_dir, name, split, layout=None):
+    """ Path of one converted CIFAR-10 array inside cache_dir. """
+    if layout is None:
+        return os.path.join(cache_dir, '%s_%s.npy' % (name, split))
+    return os.path.join(cache_dir,
+                        '%s_%s_%s.npy' % (name, split, layout.lower()))
+
+
+def _save_atomic(path, array):
+    """
+    Save array as a .npy file by writing a temporary file next to path and
+    moving it into place with os.replace, so readers never see a partially
+    written file and an existing file is overwritten on every platform.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix='.npy.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
 def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
-                     subtract_mean=True):
+                     subtract_mean=True, dtype=np.float64, lazy=False,
+                     cifar10_dir='cs231n/datasets/cifar-10-batches-py'):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
     condensed to a single function.
+
+    The images are read from the uint8 (N, 3, 32, 32) memory map written by
+    load_CIFAR10_mmap, so the splits are plain slices and no transpose is
+    needed. The mean training image is computed once per num_training and
+    stored next to that memory map.
+
+    Inputs:
+    - num_training, num_validation, num_test: Sizes of the splits.
+    - subtract_mean: Whether to subtract the mean training image.
+    - dtype: Floating point dtype of the returned images; np.float32 halves
+      the memory footprint.
+    - lazy: If True, the X arrays are LazyFloatArrays over the memory map that
+      convert and mean-subtract only the images that are indexed, e.g. one
+      minibatch at a time. If False, each split is converted into a single
+      array of the requested dtype in chunks, without intermediate copies.
+    - cifar10_dir: Directory holding the pickled CIFAR-10 batches.
     """
     # Load the raw CIFAR-10 data
-    cifar10_dir = 'cs231n/datasets/cifar-10-batches-py'
-    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
+    X_train, y_train, X_test, y_test = load_CIFAR10_mmap(cifar10_dir,
+                                                         layout='NCHW')
 
-    # Subsample the data
-    mask = list(range(num_training, num_training + num_validation))
-    X_val = X_train[mask]
-    y_val = y_train[mask]
-    mask = list(range(num_training))
-    X_train = X_train[mask]
-    y_train = y_train[mask]
-    mask = list(range(num_test))
-    X_test = X_test[mask]
-    y_test = y_test[mask]
-
-    # Normalize the data: subtract the mean image
+    mean_image = None
     if subtract_mean:
-        mean_image = np.mean(X_train, axis=0)
-        X_train -= mean_image
-        X_val -= mean_image
-        X_test -= mean_image
+        mean_path = os.path.join(cifar10_dir, 'uint8',
+                                 'mean_train_%d_nchw.npy' % num_training)
+        mean_image = _cached_mean_image(mean_path, X_train, num_training)
+        mean_image = mean_image.astype(dtype)
 
-    # Transpose so that channels come first
-    X_train = X_train.transpose(0, 3, 1, 2).copy()
-    X_val = X_val.transpose(0, 3, 1, 2).copy()
-    X_test = X_test.transpose(0, 3, 1, 2).copy()
+    # Subsample the data
+    splits = {
+        'train': (X_train[:num_training], y_train[:num_training]),
+        'val': (X_train[num_training:num_training + num_validation],
+                y_train[num_training:num_training + num_validation]),
+        'test': (X_test[:num_test], y_test[:num_test]),
+    }
+    for split, (X, y) in splits.items():
+        if lazy:
+            X = LazyFloatArray(X, dtype, mean=mean_image)
+        else:
+            X = _preprocess_images(X, dtype, mean_image)
+        splits[split] = X, np.array(y)
+    X_train, y_train = splits['train']
+    X_val, y_val = splits['val']
+    X_test, y_test = splits['test']
 
     # Package data into a dictionary
     return {
@@ -85,16 +276,27 @@ def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
     }
 
 
-def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
+def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True, lazy=False,
+                       num_workers=None):
     """
     Load TinyImageNet. Each of TinyImageNet-100-A, TinyImageNet-100-B, and
     TinyImageNet-200 have the same directory structure, so this can be used
     to load any of them.
 
+    The first call decodes the JPEGs with a pool of worker processes straight
+    into packed uint8 (N, 3, 64, 64) .npy files under path/uint8, together
+    with an index of labels and class names. Later calls only memory-map
+    those files.
+
     Inputs:
     - path: String giving path to the directory to load.
     - dtype: numpy datatype used to load the data.
     - subtract_mean: Whether to subtract the mean training image.
+    - lazy: If True, the X arrays are LazyFloatArrays over the memory maps
+      that convert to dtype (and subtract the mean) only the images that are
+      indexed, e.g. one minibatch at a time.
+    - num_workers: Number of processes used to decode the images; defaults to
+      the number of CPUs.
 
     Returns: A dictionary with the following entries:
     - class_names: A list where class_names[i] is a list of strings giving the
@@ -108,8 +310,53 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
       (such as in student code) then y_test will be None.
     - mean_image: (3, 64, 64) array giving mean training image
     """
+    cache_dir = os.path.join(path, 'uint8')
+    index_file = os.path.join(cache_dir, 'index.pkl')
+    if not os.path.isfile(index_file):
+        _convert_tiny_imagenet(path, cache_dir, num_workers)
+    with open(index_file, 'rb') as f:
+        index = load_pickle(f)
+    class_names = index['class_names']
+
+    X = {}
+    for split in ('train', 'val', 'test'):
+        X[split] = np.load(os.path.join(cache_dir, 'X_%s.npy' % split),
+                           mmap_mode='r')
+    mean_image = _cached_mean_image(os.path.join(cache_dir, 'mean_train.npy'),
+                                    X['train'], X['train'].shape[0])
+    mean_image = mean_image.astype(dtype)
+
+    for split in X:
+        mean = mean_image if subtract_mean else None
+        if lazy:
+            X[split] = LazyFloatArray(X[split], dtype, mean=mean)
+        else:
+            X[split] = _preprocess_images(X[split], dtype, mean)
+    X_train, X_val, X_test = X['train'], X['val'], X['test']
+    y_train, y_val, y_test = index['y_train'], index['y_val'], index['y_test']
+
+    return {
+        'class_names': class_names,
+        'X_train': X_train,
+        'y_train': y_train,
+        'X_val': X_val,
+        'y_val': y_val,
+        'X_test': X_test,
+        'y_test': y_test,
+        'class_names': class_names,
+        'mean_image': mean_image,
+    }
+
+
+def _convert_tiny_imagenet(path, cache_dir, num_workers=None,
+                           chunk_size=2000):
+    """
+    Decode all TinyImageNet images under path into uint8 .npy files in
+    cache_dir, writing the index file last so that its presence means the
+    conversion has finished.
+    """
     # First load wnids
-    with open(os.path.join(path, 'wnids.txt'), mode='r') as f:
+    with open(os.path.join(path, 'wnids.txt'), 'r') as f:
         wnids = [x.strip() for x in f]
 
     # Map wnids to integer labels
@@ -118,68 +365,39 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
     # Use words.txt to get names for each class
     with open(os.path.join(path, 'words.txt'), 'r') as f:
         wnid_to_words = dict(line.split('\t') for line in f)
-        for wnid, words in wnid_to_words.iteritems():
+        for wnid, words in wnid_to_words.items():
             wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
     class_names = [wnid_to_words[wnid] for wnid in wnids]
 
-    # Next load training data.
-    X_train = []
+    # Training images; to figure out the filenames we need to open the boxes
+    # file of every synset.
+    train_files = []
     y_train = []
-    for i, wnid in enumerate(wnids):
-        if (i + 1) % 20 == 0:
-            print('loading training data for synset %d / %d' % (i + 1, len(wnids)))
-        # To figure out the filenames we need to open the boxes file
+    for wnid in wnids:
         boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
         with open(boxes_file, 'r') as f:
             filenames = [x.split('\t')[0] for x in f]
-        num_images = len(filenames)
-    
-        X_train_block = np.zeros((num_images, 3, 64, 64), dtype=dtype)
-        y_train_block = wnid_to_label[wnid] * np.ones(num_images, dtype=np.int64)
-        for j, img_file in enumerate(filenames):
-            img_file = os.path.join(path, 'train', wnid, 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:
-                ## grayscale file
-                img.shape = (64, 64, 1)
-            X_train_block[j] = img.transpose(2, 0, 1)
-        X_train.append(X_train_block)
-        y_train.append(y_train_block)
-
-    # We need to concatenate all training data
-    X_train = np.concatenate(X_train, axis=0)
-    y_train = np.concatenate(y_train, axis=0)
-
-    # Next load validation data
+        images_dir = os.path.join(path, 'train', wnid, 'images')
+        train_files.extend(os.path.join(images_dir, img_file)
+                           for img_file in filenames)
+        y_train.extend([wnid_to_label[wnid]] * len(filenames))
+    y_train = np.array(y_train, dtype=np.int64)
+
+    # Validation images
     with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
-        img_files = []
+        val_files = []
         val_wnids = []
         for line in f:
             img_file, wnid = line.split('\t')[:2]
-            img_files.append(img_file)
+            val_files.append(os.path.join(path, 'val', 'images', img_file))
             val_wnids.append(wnid)
-        num_val = len(img_files)
-        y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
-        X_val = np.zeros((num_val, 3, 64, 64), dtype=dtype)
-        for i, img_file in enumerate(img_files):
-            img_file = os.path.join(path, 'val', 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:
-                img.shape = (64, 64, 1)
-            X_val[i] = img.transpose(2, 0, 1)
-
-    # Next load test images
+    y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
+
     # Students won't have test labels, so we need to iterate over files in the
     # images directory.
     img_files = os.listdir(os.path.join(path, 'test', 'images'))
-    X_test = np.zeros((len(img_files), 3, 64, 64), dtype=dtype)
-    for i, img_file in enumerate(img_files):
-        img_file = os.path.join(path, 'test', 'images', img_file)
-        img = imread(img_file)
-        if img.ndim == 2:
-            img.shape = (64, 64, 1)
-        X_test[i] = img.transpose(2, 0, 1)
-
+    test_files = [os.path.join(path, 'test', 'images', img_file)
+                  for img_file in img_files]
     y_test = None
     y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
     if os.path.isfile(y_test_file):
@@ -188,26 +406,57 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
             for line in f:
                 line = line.split('\t')
                 img_file_to_wnid[line[0]] = line[1]
-        y_test = [wnid_to_label[img_file_to_wnid[img_file]] for img_file in img_files]
+        y_test = [wnid_to_label[img_file_to_wnid[img_file]]
+                  for img_file in img_files]
         y_test = np.array(y_test)
 
-    mean_image = X_train.mean(axis=0)
-    if subtract_mean:
-        X_train -= mean_image[None]
-        X_val -= mean_image[None]
-        X_test -= mean_image[None]
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for split, files in (('train', train_files), ('val', val_files),
+                             ('test', test_files)):
+            array_path = os.path.join(cache_dir, 'X_%s.npy' % split)
+            np.lib.format.open_memmap(array_path, mode='w+', dtype=np.uint8,
+                                      shape=(len(files), 3, 64, 64))
+            tasks = [(array_path, start, files[start:start + chunk_size])
+                     for start in range(0, len(files), chunk_size)]
+            num_done = 0
+            for num_decoded in pool.imap_unordered(_decode_images, tasks):
+                num_done += num_decoded
+                print('decoded %s images %d / %d'
+                      % (split, num_done, len(files)))
+    finally:
+        pool.close()
+        pool.join()
 
-    return {
+    index = {
         'class_names': class_names,
-        'X_train': X_train,
         'y_train': y_train,
-        'X_val': X_val,
         'y_val': y_val,
-        'X_test': X_test,
         'y_test': y_test,
-        'class_names': class_names,
-        'mean_image': mean_image,
     }
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.pkl.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(index, f, protocol=2)
+    os.replace(tmp_path, os.path.join(cache_dir, 'index.pkl'))
+
+
+def _decode_images(task):
+    """
+    Decode the image files of one task into consecutive rows, starting at
+    row start, of the uint8 .npy file at array_path.
+    """
+    array_path, start, filenames = task
+    X = np.load(array_path, mmap_mode='r+')
+    for i, img_file in enumerate(filenames):
+        img = imread(img_file)
+        if img.ndim == 2:
+            ## grayscale file
+            img.shape = (64, 64, 1)
+        X[start + i] = img.transpose(2, 0, 1)
+    X.flush()
+    return len(filenames)
 
 
 def load_models(models_dir):
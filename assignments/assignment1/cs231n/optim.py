@@ -0,0 +1,199 @@
+import math
+
+import numpy as np
+
+"""
+This file implements first-order update rules used by LinearClassifier.train.
+They follow the same interface as the update rules of assignment 2:
+
+def update(w, dw, config=None):
+
+Inputs:
+  - w: A numpy array giving the current weights.
+  - dw: A numpy array of the same shape as w giving the gradient of the
+    loss with respect to w.
+  - config: A dictionary containing hyperparameter values such as learning
+    rate, momentum, etc. If the update rule requires caching values over many
+    iterations, then config will also hold these cached values.
+
+Returns:
+  - next_w: The next point after the update.
+  - config: The config dictionary to be passed to the next iteration of the
+    update rule.
+
+All update rules here update w (and their cached values) in place and return
+next_w = w. Intermediate results go to a scratch array of the shape of w that
+is cached in config, so after the first step an update allocates no arrays.
+None of them modify dw or keep a reference to it, so dw may be a buffer that
+is reused between steps.
+
+This file also implements learning rate schedules, which map a base learning
+rate and an iteration number to the learning rate for that iteration.
+"""
+
+
+def _cached_like(config, key, w):
+    """
+    Returns the array cached in config[key], first setting it to an array of
+    zeros of the shape and datatype of w.
+    """
+    if key not in config:
+        config[key] = np.zeros_like(w)
+    return config[key]
+
+
+def sgd(w, dw, config=None):
+    """
+    Performs vanilla stochastic gradient descent.
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    """
+    if config is None:
+        config = {}
+    config.setdefault('learning_rate', 1e-2)
+    scratch = _cached_like(config, 'scratch', w)
+
+    np.multiply(dw, config['learning_rate'], out=scratch)
+    w -= scratch
+    return w, config
+
+
+def sgd_momentum(w, dw, config=None):
+    """
+    Performs stochastic gradient descent with momentum.
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    - momentum: Scalar between 0 and 1 giving the momentum value.
+      Setting momentum = 0 reduces to sgd.
+    - velocity: A numpy array of the same shape as w and dw used to store a
+      moving average of the gradients.
+    """
+    if config is None:
+        config = {}
+    config.setdefault('learning_rate', 1e-2)
+    config.setdefault('momentum', 0.9)
+    v = _cached_like(config, 'velocity', w)
+    scratch = _cached_like(config, 'scratch', w)
+
+    v *= config['momentum']
+    np.multiply(dw, config['learning_rate'], out=scratch)
+    v -= scratch
+    w += v
+    return w, config
+
+
+def nesterov_momentum(w, dw, config=None):
+    """
+    Performs stochastic gradient descent with Nesterov momentum, which
+    evaluates the momentum step from the look-ahead position.
+
+    config format: Same as sgd_momentum.
+    """
+    if config is None:
+        config = {}
+    config.setdefault('learning_rate', 1e-2)
+    config.setdefault('momentum', 0.9)
+    v = _cached_like(config, 'velocity', w)
+    scratch = _cached_like(config, 'scratch', w)
+
+    mu = config['momentum']
+    learning_rate = config['learning_rate']
+
+    # v_new = mu * v - lr * dw; w += -mu * v + (1 + mu) * v_new, which
+    # simplifies to w += mu * v_new - lr * dw.
+    v *= mu
+    np.multiply(dw, learning_rate, out=scratch)
+    v -= scratch
+    w -= scratch
+    np.multiply(v, mu, out=scratch)
+    w += scratch
+    return w, config
+
+
+def adam(w, dw, config=None):
+    """
+    Uses the Adam update rule, which incorporates moving averages of both the
+    gradient and its square and a bias correction term.
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    - beta1: Decay rate for moving average of first moment of gradient.
+    - beta2: Decay rate for moving average of second moment of gradient.
+    - epsilon: Small scalar used for smoothing to avoid dividing by zero.
+    - m: Moving average of gradient.
+    - v: Moving average of squared gradient.
+    - t: Iteration number.
+    """
+    if config is None:
+        config = {}
+    config.setdefault('learning_rate', 1e-3)
+    config.setdefault('beta1', 0.9)
+    config.setdefault('beta2', 0.999)
+    config.setdefault('epsilon', 1e-8)
+    m = _cached_like(config, 'm', w)
+    v = _cached_like(config, 'v', w)
+    scratch = _cached_like(config, 'scratch', w)
+    config.setdefault('t', 0)
+
+    beta1 = config['beta1']
+    beta2 = config['beta2']
+    config['t'] += 1
+    t = config['t']
+
+    m *= beta1
+    np.multiply(dw, 1 - beta1, out=scratch)
+    m += scratch
+    v *= beta2
+    np.square(dw, out=scratch)
+    scratch *= 1 - beta2
+    v += scratch
+
+    # Fold both bias corrections into the step size.
+    # Python floats rather than numpy float64 scalars keep float32 arithmetic
+    # from going through temporary float64 buffers.
+    step = config['learning_rate'] * (1 - beta2 ** t) ** 0.5 / (1 - beta1 ** t)
+    np.sqrt(v, out=scratch)
+    scratch += config['epsilon'] * (1 - beta2 ** t) ** 0.5
+    np.divide(m, scratch, out=scratch)
+    scratch *= step
+    w -= scratch
+    return w, config
+
+
+def constant_schedule(learning_rate, it, num_iters, config=None):
+    """
+    Keeps the learning rate fixed.
+    """
+    return learning_rate
+
+
+def step_schedule(learning_rate, it, num_iters, config=None):
+    """
+    Multiplies the learning rate by a constant factor every few iterations.
+
+    config format:
+    - step_size: Number of iterations between decays.
+    - decay: Factor the learning rate is multiplied by at each decay.
+    """
+    if config is None:
+        config = {}
+    step_size = config.get('step_size', max(num_iters // 3, 1))
+    decay = config.get('decay', 0.1)
+    return learning_rate * decay ** (it // step_size)
+
+
+def cosine_schedule(learning_rate, it, num_iters, config=None):
+    """
+    Anneals the learning rate from its base value to min_learning_rate along
+    half a cosine wave over num_iters iterations.
+
+    config format:
+    - min_learning_rate: Learning rate reached at the last iteration.
+    """
+    if config is None:
+        config = {}
+    min_learning_rate = config.get('min_learning_rate', 0.0)
+    cosine = 0.5 * (1 + math.cos(math.pi * it / max(num_iters, 1)))
+    return min_learning_rate + (learning_rate - min_learning_rate) * cosine
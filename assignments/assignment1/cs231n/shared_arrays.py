@@ -0,0 +1,69 @@
+import numpy as np
+
+
+"""
+Helpers for sharing numpy arrays with worker processes.
+
+multiprocessing.shared_memory only exists from Python 3.8 on, so it is
+imported when an array is first shared rather than with this module; code
+that imports these helpers keeps working on older Pythons as long as it runs
+in a single process.
+"""
+
+
+def to_shared_memory(array):
+  """
+  Copy a numpy array into a new shared memory block, so that worker processes
+  can read (and write) it without receiving pickled copies.
+
+  Inputs:
+  - array: A numpy array.
+
+  Returns a tuple of:
+  - block: The SharedMemory object; the caller must close and unlink it once
+    the workers are done. shared_array(block, spec) gives the array in this
+    process.
+  - spec: A picklable (name, shape, dtype) tuple that attach_shared_memory
+    uses to map the array in another process.
+  """
+  from multiprocessing import shared_memory
+
+  array = np.ascontiguousarray(array)
+  block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+  spec = (block.name, array.shape, array.dtype.str)
+  shared = shared_array(block, spec)
+  shared[...] = array
+  del shared
+  return block, spec
+
+
+def attach_shared_memory(spec):
+  """
+  Map an array created by to_shared_memory in this process.
+
+  Inputs:
+  - spec: The (name, shape, dtype) tuple returned by to_shared_memory.
+
+  Returns a tuple of:
+  - block: The SharedMemory object; keep a reference to it for as long as the
+    array is used.
+  - array: A numpy array backed by the shared memory.
+  """
+  from multiprocessing import shared_memory
+
+  name, shape, dtype = spec
+  block = shared_memory.SharedMemory(name=name)
+  return block, shared_array(block, spec)
+
+
+def shared_array(block, spec):
+  """
+  The numpy array described by spec, backed by the memory of block.
+
+  The array keeps the buffer of block exported for as long as it (or any view
+  of it) is alive, so that block.close() raises BufferError rather than
+  unmapping memory that is still in use.
+  """
+  name, shape, dtype = spec
+  count = int(np.prod(shape))
+  return np.frombuffer(block.buf, dtype=dtype, count=count).reshape(shape)
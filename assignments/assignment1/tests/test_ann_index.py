@@ -0,0 +1,16 @@
+import numpy as np
+
+from cs231n.classifiers.ann_index import IVFPQIndex
+
+
+def test_fit_with_sample_smaller_than_num_lists_and_codebook():
+    rng = np.random.RandomState(0)
+    X = rng.randn(1000, 16)
+    index = IVFPQIndex(num_lists=64, num_subvectors=4, max_train_points=100)
+    index.fit(X)
+
+    assert index.centroids.shape[0] <= 100
+    assert all(codebook.shape[0] <= 100 for codebook in index.codebooks)
+    dists, idx = index.search(X[:5], k=3, num_probes=index.centroids.shape[0])
+    assert idx.shape == (5, 3)
+    assert np.all(idx >= 0)
@@ -0,0 +1,15 @@
+import numpy as np
+
+from cs231n.features import extract_features, hog_feature
+
+
+def test_extract_features_grayscale_with_trailing_channel():
+  rng = np.random.RandomState(0)
+  imgs = rng.rand(5, 32, 32, 1) * 255
+
+  feats = extract_features(imgs, [hog_feature], batch_size=2)
+
+  # The per-image path squeezes the channel axis away.
+  expected = np.array([hog_feature(img.squeeze()) for img in imgs])
+  assert feats.shape == expected.shape
+  assert np.allclose(feats, expected)
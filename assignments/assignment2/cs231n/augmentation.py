@@ -0,0 +1,208 @@
+from builtins import range
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+"""
+This file implements data augmentation that works on a whole minibatch of
+images of shape (N, C, H, W) at once, using strided views and vectorized
+numpy operations instead of a Python loop over the images.
+
+The functions take a numpy RandomState rng so that they can run on the
+background thread of a BatchLoader without touching np.random.
+"""
+
+
+def random_crop(X, padding, rng, out=None):
+    """
+    Pad every image with zeros and take a random H x W crop from it, which
+    shifts each image by up to padding pixels in each direction.
+
+    Inputs:
+    - X: Array of shape (N, C, H, W) of images.
+    - padding: Number of zero pixels added on each side.
+    - rng: numpy RandomState used to choose the crops.
+    - out: Optional array of the same shape as X to write the crops to; it
+      may be X itself.
+
+    Returns:
+    - out: Array of shape (N, C, H, W) of cropped images.
+    """
+    N, C, H, W = X.shape
+    X_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
+                        dtype=X.dtype)
+    X_padded[:, :, padding:padding + H, padding:padding + W] = X
+    return _crop_padded(X_padded, H, W, padding, rng, out)
+
+
+def _crop_padded(X_padded, H, W, padding, rng, out=None):
+    """ Random H x W crops of already padded images; see random_crop. """
+    N, C = X_padded.shape[:2]
+    s0, s1, s2, s3 = X_padded.strides
+
+    # windows[n, i, j] is a view of the crop of image n at offset (i, j).
+    windows = as_strided(X_padded,
+                         shape=(N, 2 * padding + 1, 2 * padding + 1, C, H, W),
+                         strides=(s0, s2, s3, s1, s2, s3))
+    offsets_y = rng.randint(0, 2 * padding + 1, size=N)
+    offsets_x = rng.randint(0, 2 * padding + 1, size=N)
+    crops = windows[np.arange(N), offsets_y, offsets_x]
+    if out is None:
+        return crops
+    out[...] = crops
+    return out
+
+
+def random_flip(X, rng):
+    """
+    Flip a random half of the images horizontally, in place.
+
+    Inputs:
+    - X: Array of shape (N, C, H, W) of images.
+    - rng: numpy RandomState used to choose the images to flip.
+
+    Returns:
+    - X: The same array, with the chosen images flipped.
+    """
+    flip = np.nonzero(rng.rand(X.shape[0]) < 0.5)[0]
+    X[flip] = X[flip, :, :, ::-1]
+    return X
+
+
+def color_jitter(X, rng, brightness=0.0, contrast=0.0, saturation=0.0):
+    """
+    Randomly change the brightness, contrast and saturation of every image,
+    in place. Each image draws its own factors.
+
+    Inputs:
+    - X: Array of shape (N, C, H, W) of floating point images.
+    - rng: numpy RandomState used to draw the factors.
+    - brightness: A value drawn uniformly from [-brightness, brightness] is
+      added to every pixel of an image, in the units of X.
+    - contrast: Every image is scaled about its mean by a factor drawn
+      uniformly from [1 - contrast, 1 + contrast].
+    - saturation: Every image is blended with its grayscale version (the
+      mean over channels) with a factor drawn uniformly from
+      [1 - saturation, 1 + saturation]; 0 gives grayscale.
+
+    Returns:
+    - X: The same array, with the jitter applied.
+    """
+    N = X.shape[0]
+    if saturation > 0:
+        factor = rng.uniform(1 - saturation, 1 + saturation, size=N)
+        factor = factor.astype(X.dtype)[:, None, None, None]
+        gray = np.mean(X, axis=1, keepdims=True)
+        X -= gray
+        X *= factor
+        X += gray
+    if contrast > 0:
+        factor = rng.uniform(1 - contrast, 1 + contrast, size=N)
+        factor = factor.astype(X.dtype)[:, None, None, None]
+        mean = np.mean(X, axis=(1, 2, 3), keepdims=True)
+        X -= mean
+        X *= factor
+        X += mean
+    if brightness > 0:
+        shift = rng.uniform(-brightness, brightness, size=N)
+        X += shift.astype(X.dtype)[:, None, None, None]
+    return X
+
+
+class Augmenter(object):
+    """
+    An Augmenter applies random crops, horizontal flips and colour jitter to
+    minibatches. It has the transform interface of BatchLoader, so it can be
+    passed to a Solver as the augment option:
+
+    solver = Solver(model, data, augment=Augmenter(padding=4, flip=True),
+                    num_prefetch=2)
+
+    Minibatches are augmented in place; the padded images used for cropping
+    live in a buffer that is reused from batch to batch.
+    """
+
+    def __init__(self, padding=0, flip=False, brightness=0.0, contrast=0.0,
+                 saturation=0.0, seed=None):
+        """
+        Inputs:
+        - padding: Pad images by this many pixels and take random crops of
+          the original size; 0 disables cropping.
+        - flip: Whether to flip a random half of the images horizontally.
+        - brightness, contrast, saturation: Colour jitter strengths; see
+          color_jitter.
+        - seed: Seed for the random number generator; default is None, which
+          draws a seed from np.random.
+        """
+        self.padding = padding
+        self.flip = flip
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        self.rng = np.random.RandomState(seed)
+        self.padded = None
+
+    def __call__(self, X, y):
+        if self.padding > 0:
+            N, C, H, W = X.shape
+            p = self.padding
+            shape = (N, C, H + 2 * p, W + 2 * p)
+            if (self.padded is None or self.padded.shape != shape
+                    or self.padded.dtype != X.dtype):
+                # The border stays zero, so only the interior is rewritten.
+                self.padded = np.zeros(shape, dtype=X.dtype)
+            self.padded[:, :, p:p + H, p:p + W] = X
+            _crop_padded(self.padded, H, W, p, self.rng, out=X)
+        if self.flip:
+            random_flip(X, self.rng)
+        if self.brightness > 0 or self.contrast > 0 or self.saturation > 0:
+            color_jitter(X, self.rng, self.brightness, self.contrast,
+                         self.saturation)
+        return X, y
+
+
+def benchmark_augmenter(augmenter, model, X, y, batch_size=100, num_trials=10):
+    """
+    Compare the time an augmenter takes per minibatch with the time of a
+    training step (forward and backward pass) of a model.
+
+    Inputs:
+    - augmenter: A function with the interface of Augmenter.
+    - model: A model object with the API expected by Solver.
+    - X: Array of shape (N, C, H, W) of training images.
+    - y: Array of shape (N,) of labels.
+    - batch_size: Size of the minibatches.
+    - num_trials: Number of minibatches to time.
+
+    Returns a dictionary with the keys:
+    - augment_time: Average seconds spent augmenting one minibatch.
+    - step_time: Average seconds of model.loss on one minibatch.
+    - fraction: augment_time / step_time.
+    """
+    rng = np.random.RandomState(0)
+    augment_time = 0.0
+    step_time = 0.0
+    for t in range(num_trials):
+        batch_mask = rng.choice(X.shape[0], batch_size)
+        X_batch = X[batch_mask]
+        y_batch = y[batch_mask]
+
+        tic = time.time()
+        X_batch, y_batch = augmenter(X_batch, y_batch)
+        augment_time += time.time() - tic
+
+        tic = time.time()
+        model.loss(X_batch, y_batch)
+        step_time += time.time() - tic
+
+    augment_time /= num_trials
+    step_time /= num_trials
+    return {
+      'augment_time': augment_time,
+      'step_time': step_time,
+      'fraction': augment_time / step_time,
+    }
@@ -0,0 +1,134 @@
+import glob
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+from six.moves import queue
+
+
+"""
+This file implements the checkpoint format used by Solver. A checkpoint is a
+single uncompressed .npz file: every array (parameters, optimizer moments,
+histories, random number generator keys) is stored as its own entry, and
+everything else goes into a JSON document stored in the '__meta__' entry.
+"""
+
+
+def save_checkpoint(path, arrays, meta):
+    """
+    Write a checkpoint file. The file is written under a temporary name and
+    renamed into place, replacing any existing file of that name, so a crash
+    never leaves a truncated checkpoint.
+
+    Inputs:
+    - path: Path of the .npz file to write.
+    - arrays: Dictionary mapping entry names to numpy arrays.
+    - meta: JSON-serializable dictionary of everything else.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.npz.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, __meta__=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path):
+    """
+    Read a checkpoint written by save_checkpoint.
+
+    Returns a tuple of:
+    - arrays: Dictionary mapping entry names to numpy arrays.
+    - meta: The dictionary of everything else.
+    """
+    with np.load(path) as f:
+        meta = json.loads(str(f['__meta__']))
+        arrays = {k: f[k] for k in f.files if k != '__meta__'}
+    return arrays, meta
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread so that training does not wait
+    for the disk, and deletes old checkpoints so that only the last keep_last
+    remain. The arrays handed to save() must not be modified afterwards, so
+    callers pass copies.
+
+    Old checkpoints are found by globbing pattern, so files left by earlier
+    runs count as well; they are older than anything written by this writer,
+    and are ordered among themselves by modification time.
+
+    An error raised while writing is re-raised by the next call to save() or
+    close().
+    """
+
+    def __init__(self, keep_last=None, pattern=None):
+        """
+        Inputs:
+        - keep_last: Number of most recent checkpoints to keep on disk, at
+          least 1; default is None, which keeps all of them.
+        - pattern: Optional glob pattern matching all checkpoint files of the
+          run, including those written before this writer was created.
+        """
+        if keep_last is not None and keep_last < 1:
+            raise ValueError('keep_last must be at least 1')
+        self.keep_last = keep_last
+        self.pattern = pattern
+        self.written = []
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, arrays, meta = item
+            try:
+                save_checkpoint(path, arrays, meta)
+                path = os.path.abspath(path)
+                if path in self.written:
+                    self.written.remove(path)
+                self.written.append(path)
+                if self.keep_last is not None:
+                    self._prune()
+            except Exception as e:
+                self.error = e
+
+    def _prune(self):
+        """ Delete all but the keep_last most recent checkpoints. """
+        older = []
+        if self.pattern is not None:
+            older = [p for p in map(os.path.abspath, glob.glob(self.pattern))
+                     if p not in self.written]
+            older.sort(key=os.path.getmtime)
+        checkpoints = older + self.written
+        for old_path in checkpoints[:-self.keep_last]:
+            if old_path in self.written:
+                self.written.remove(old_path)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, path, arrays, meta):
+        """ Queue a checkpoint to be written by save_checkpoint. """
+        self._raise_error()
+        self.queue.put((path, arrays, meta))
+
+    def close(self):
+        """ Wait until all queued checkpoints are written. """
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
@@ -0,0 +1,143 @@
+from builtins import range
+import threading
+
+import numpy as np
+from six.moves import queue
+
+
+class BatchLoader(object):
+    """
+    A BatchLoader assembles minibatches of training data ahead of time in a
+    background thread, so that gathering the rows of the next batches (and
+    transforming them, e.g. by data augmentation) overlaps with the forward
+    and backward pass on the current one.
+
+    Batches are written into a ring of num_buffers preallocated buffers. A
+    batch returned by the loader stays valid until the next batch is
+    requested, at which point its buffer is handed back to the background
+    thread; copy it if it must be kept for longer. With num_buffers=1 no
+    thread is started and each batch is assembled when it is requested.
+
+    Example usage:
+
+    batch_indices = (np.random.choice(N, 100) for t in range(num_iterations))
+    loader = BatchLoader(X_train, y_train, batch_indices, num_buffers=3)
+    try:
+        for X_batch, y_batch in loader:
+            loss, grads = model.loss(X_batch, y_batch)
+    finally:
+        loader.close()
+    """
+
+    def __init__(self, X, y, batch_indices, num_buffers=3, transform=None):
+        """
+        Construct a new BatchLoader.
+
+        Inputs:
+        - X: Array of data, of shape (N, d_1, ..., d_k). Anything with shape,
+          dtype and numpy-style indexing works, such as a memmap or a
+          LazyFloatArray from data_utils.
+        - y: Array of labels, of shape (N,).
+        - batch_indices: Iterable giving, for every batch, an integer array or
+          a slice that selects the rows of the batch. The loader stops when
+          it is exhausted.
+        - num_buffers: Number of buffers in the ring; up to num_buffers - 1
+          batches are assembled ahead of the one in use.
+        - transform: Optional function called on every batch as
+          X_batch, y_batch = transform(X_batch, y_batch) after it is gathered.
+          With a background thread it runs on that thread.
+        """
+        self.X = X
+        self.y = y
+        self.transform = transform
+        self.buffers = [None] * num_buffers
+        self.current_slot = None
+
+        self.batch_indices = iter(batch_indices)
+        self.thread = None
+        if num_buffers > 1:
+            self.free_slots = queue.Queue()
+            for slot in range(num_buffers):
+                self.free_slots.put(slot)
+            self.ready = queue.Queue()
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self._fill)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _assemble(self, slot, indices):
+        """
+        Gather the rows selected by indices into the buffer of the given slot
+        and apply the transform.
+        """
+        if isinstance(indices, slice):
+            num_rows = len(range(*indices.indices(self.X.shape[0])))
+        else:
+            num_rows = len(indices)
+
+        buf = self.buffers[slot]
+        if buf is None or buf.shape[0] < num_rows:
+            buf = np.empty((num_rows,) + tuple(self.X.shape[1:]),
+                           dtype=self.X.dtype)
+            self.buffers[slot] = buf
+        X_batch = buf[:num_rows]
+        if isinstance(self.X, np.ndarray) and not isinstance(indices, slice):
+            np.take(self.X, indices, axis=0, out=X_batch)
+        else:
+            X_batch[...] = self.X[indices]
+        y_batch = self.y[indices]
+
+        if self.transform is not None:
+            X_batch, y_batch = self.transform(X_batch, y_batch)
+        return X_batch, y_batch
+
+    def _fill(self):
+        try:
+            for indices in self.batch_indices:
+                slot = self._get_free_slot()
+                if slot is None:
+                    return
+                self.ready.put((True, slot, self._assemble(slot, indices)))
+            self.ready.put((False, None, None))
+        except Exception as e:
+            self.ready.put((False, None, e))
+
+    def _get_free_slot(self):
+        # Wake up regularly so that close() can stop a blocked producer.
+        while not self.stopped.is_set():
+            try:
+                return self.free_slots.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.thread is None:
+            return self._assemble(0, next(self.batch_indices))
+
+        # The caller is done with the previous batch, so its buffer can be
+        # refilled.
+        if self.current_slot is not None:
+            self.free_slots.put(self.current_slot)
+            self.current_slot = None
+
+        ok, slot, item = self.ready.get()
+        if ok:
+            self.current_slot = slot
+            return item
+        # Leave the end marker for any later call.
+        self.ready.put((False, None, item))
+        if item is None:
+            raise StopIteration
+        raise item
+
+    next = __next__
+
+    def close(self):
+        """ Stop the background thread and wait for it to finish. """
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
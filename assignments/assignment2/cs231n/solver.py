@@ -1,5 +1,7 @@
+import glob
+import multiprocessing
 import os
-import pickle
+import traceback
 import numpy as np
 
 #from future import standard_library
@@ -15,6 +17,8 @@ import numpy as np
 #import numpy as np
 
 from cs231n import optim
+from cs231n.checkpoint import CheckpointWriter, load_checkpoint
+from cs231n.data_loader import BatchLoader
 
 
 class Solver():
@@ -30,7 +34,9 @@ class Solver():
     To train a model, you will first construct a Solver instance, passing the
     model, dataset, and various options (learning rate, batch size, etc) to the
     constructor. You will then call the train() method to run the optimization
-    procedure and train the model.
+    procedure and train the model. train() runs until num_epochs epochs have
+    been completed, so a Solver that was restored from a checkpoint with
+    resume() continues where the checkpoint left off.
 
     After the train() method returns, model.params will contain the parameters
     that performed best on the validation set over the course of training.
@@ -109,6 +115,16 @@ class Solver():
         - batch_size: Size of minibatches used to compute loss and gradient
           during training.
         - num_epochs: The number of epochs to run for during training.
+        - sampling: How minibatches are drawn from the training data:
+          'random' (default) samples every minibatch independently with
+          replacement; 'epoch' shuffles the training data once per pass and
+          splits it into minibatches, so a pass visits every sample once.
+        - drop_last: With 'epoch' sampling, whether to drop the last, smaller
+          minibatch of every pass. Default is False.
+        - epoch_size: Number of training samples per epoch; default is None,
+          which uses the entire training set. Smaller values give more
+          frequent accuracy checks and learning rate decay; with 'epoch'
+          sampling, consecutive epochs then continue the same pass.
         - print_every: Integer; training losses will be printed every
           print_every iterations.
         - verbose: Boolean; if set to false then no output will be printed
@@ -118,7 +134,33 @@ class Solver():
         - num_val_samples: Number of validation samples to use to check val
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
-          epoch.
+          epoch, as checkpoint_name + '_epoch_%d.npz'. Checkpoints hold the
+          parameters, the optimizer state, the histories and the random
+          number generator states, and are written by a background thread.
+        - keep_checkpoints: Number of most recent checkpoints to keep on disk,
+          at least 1; default is None, which keeps all of them. Checkpoints
+          of checkpoint_name left by earlier runs count towards the limit.
+        - num_prefetch: Number of minibatches assembled ahead of time by a
+          background thread (see data_loader.BatchLoader), overlapping batch
+          preparation with the forward and backward pass. Default is 0, which
+          assembles each minibatch when it is needed.
+        - augment: Optional function applied to every training minibatch as
+          X_batch, y_batch = augment(X_batch, y_batch), such as an
+          augmentation.Augmenter. With num_prefetch > 0 it runs on the
+          background thread.
+        - num_workers: Number of worker processes for data-parallel training;
+          default is 1, which trains in this process. With K > 1 workers,
+          train() forks K processes that each hold a replica of the model.
+          Every minibatch is split into K shards, each worker computes the
+          loss and gradients of its shard, the gradients are averaged
+          through shared memory and the update is applied once, to
+          parameters that all replicas share. The running statistics of
+          batch normalization (model.bn_params) are taken from the first
+          worker. Needs a platform that can fork; set OMP_NUM_THREADS so
+          that K times the BLAS threads fit the cores of the machine.
+        - seed: Seed for the random number generator used to sample
+          minibatches; default is None, which draws a seed from np.random so
+          that np.random.seed still makes training reproducible.
         """
         self.model = model
         self.X_train = data['X_train']
@@ -132,12 +174,20 @@ class Solver():
         self.lr_decay = kwargs.pop('lr_decay', 1.0)
         self.batch_size = kwargs.pop('batch_size', 100)
         self.num_epochs = kwargs.pop('num_epochs', 10)
+        self.sampling = kwargs.pop('sampling', 'random')
+        self.drop_last = kwargs.pop('drop_last', False)
+        self.epoch_size = kwargs.pop('epoch_size', None)
         self.num_train_samples = kwargs.pop('num_train_samples', 1000)
         self.num_val_samples = kwargs.pop('num_val_samples', None)
 
         self.checkpoint_name = kwargs.pop('checkpoint_name', None)
+        self.keep_checkpoints = kwargs.pop('keep_checkpoints', None)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.num_prefetch = kwargs.pop('num_prefetch', 0)
+        self.augment = kwargs.pop('augment', None)
+        self.num_workers = kwargs.pop('num_workers', 1)
+        seed = kwargs.pop('seed', None)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -150,6 +200,32 @@ class Solver():
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        if self.keep_checkpoints is not None and self.keep_checkpoints < 1:
+            raise ValueError('keep_checkpoints must be at least 1')
+        if self.sampling not in ('random', 'epoch'):
+            raise ValueError('Invalid sampling "%s"' % self.sampling)
+        if (self.sampling == 'epoch' and self.drop_last
+                and self.X_train.shape[0] < self.batch_size):
+            raise ValueError('drop_last needs at least batch_size samples')
+
+        # Minibatches are sampled with a generator of their own, since they
+        # may be drawn on a background thread.
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        self.batch_loader = None
+        self.workers = None
+        self.checkpoint_writer = None
+
+        # sampler_states[t] holds what is needed to draw the minibatches that
+        # follow the first t of a call to train(); see _batch_indices.
+        self.sampler_states = {}
+        self.resume_sampler = None
+        # augment_states[t] is the state of the generator of the augment
+        # function after the first t minibatches; see _make_batch_loader.
+        self.augment_states = {}
+
         self._reset()
 
 
@@ -179,13 +255,15 @@ class Solver():
         be called manually.
         """
         # Make a minibatch of training data
-        num_train = self.X_train.shape[0]
-        batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
+        if self.batch_loader is None:
+            self.batch_loader = self._make_batch_loader()
+        X_batch, y_batch = next(self.batch_loader)
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
+        if self.workers is None:
+            loss, grads = self.model.loss(X_batch, y_batch)
+        else:
+            loss, grads = self._parallel_loss(X_batch, y_batch)
         self.loss_history.append(loss)
 
         # Perform a parameter update
@@ -193,32 +271,303 @@ class Solver():
             dw = grads[p]
             config = self.optim_configs[p]
             next_w, next_config = self.update_rule(w, dw, config)
+            if self.workers is not None and next_w is not w:
+                # The replicas read the parameters from shared memory.
+                w[...] = next_w
+                next_w = w
             self.model.params[p] = next_w
             self.optim_configs[p] = next_config
 
 
-    def _save_checkpoint(self):
+    def _parallel_loss(self, X_batch, y_batch):
+        """
+        Compute the loss and gradients of a minibatch with the worker
+        processes: every worker handles a contiguous shard of the minibatch,
+        and the shard gradients are averaged, weighted by shard size.
+        """
+        N = X_batch.shape[0]
+        self.shared_X[:N] = X_batch
+        self.shared_y[:N] = y_batch
+
+        bounds = np.linspace(0, N, len(self.workers) + 1).astype(int)
+        active = []
+        for k, (process, conn) in enumerate(self.workers):
+            if bounds[k + 1] > bounds[k]:
+                conn.send(('loss', bounds[k], bounds[k + 1]))
+                active.append(k)
+
+        weights = np.diff(bounds)[active] / float(N)
+        loss = 0.0
+        for k, weight in zip(active, weights):
+            status, result = self.workers[k][1].recv()
+            if status == 'error':
+                raise RuntimeError('Worker %d failed:\n%s' % (k, result))
+            loss += weight * result
+
+        grads = {}
+        for p, shared_grad in self.shared_grads.items():
+            shard_grads = shared_grad[active].reshape(len(active), -1)
+            grad = weights.dot(shard_grads).reshape(shared_grad.shape[1:])
+            grads[p] = grad.astype(shared_grad.dtype, copy=False)
+        return loss, grads
+
+
+    def _start_workers(self):
+        """
+        Move the model parameters into shared memory and fork the worker
+        processes used by _parallel_loss.
+        """
+        ctx = multiprocessing.get_context('fork')
+        K = self.num_workers
+
+        for p, w in self.model.params.items():
+            shared_w = _shared_array(ctx, w.shape, w.dtype)
+            shared_w[...] = w
+            self.model.params[p] = shared_w
+        self.shared_grads = {}
+        for p, w in self.model.params.items():
+            self.shared_grads[p] = _shared_array(ctx, (K,) + w.shape, w.dtype)
+        self.shared_X = _shared_array(
+            ctx, (self.batch_size,) + tuple(self.X_train.shape[1:]),
+            self.X_train.dtype)
+        self.shared_y = _shared_array(ctx, (self.batch_size,),
+                                      np.asarray(self.y_train[:1]).dtype)
+
+        # Every worker gets its own seed for np.random, e.g. for dropout.
+        seeds = [(self.seed + 1 + k) % (2**31 - 1) for k in range(K)]
+        self.workers = []
+        for k in range(K):
+            conn, worker_conn = ctx.Pipe()
+            process = ctx.Process(target=_data_parallel_worker,
+                                  args=(self.model, k, worker_conn,
+                                        self.shared_X, self.shared_y,
+                                        self.shared_grads, seeds[k]))
+            process.daemon = True
+            process.start()
+            worker_conn.close()
+            self.workers.append((process, conn))
+
+
+    def _sync_workers(self):
+        """
+        Copy the batch normalization running statistics of the first worker
+        into the model of this process.
+        """
+        if self.workers is None or not hasattr(self.model, 'bn_params'):
+            return
+        conn = self.workers[0][1]
+        conn.send(('bn_params',))
+        status, result = conn.recv()
+        if status == 'error':
+            raise RuntimeError('Worker 0 failed:\n%s' % result)
+        self.model.bn_params = result
+
+
+    def _stop_workers(self):
+        """
+        Shut down the worker processes and give the model back parameters
+        that are ordinary arrays. The last iteration of train() has already
+        synced the batch normalization statistics.
+        """
+        if self.workers is None:
+            return
+        for process, conn in self.workers:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for process, conn in self.workers:
+            process.join()
+            conn.close()
+        self.workers = None
+        for p, w in self.model.params.items():
+            self.model.params[p] = w.copy()
+        del self.shared_X, self.shared_y, self.shared_grads
+
+
+    def _batch_indices(self, num_batches=None):
+        """
+        Generate the indices of num_batches minibatches of training data, or
+        indefinitely if num_batches is None.
+
+        Minibatches may be drawn ahead of time on the loader thread, so the
+        state of self.rng says little about where training is. Instead, for
+        every minibatch this records in sampler_states the generator state
+        and the position in the current pass from which the following
+        minibatches can be drawn again; checkpoints store that.
+        """
+        num_train = self.X_train.shape[0]
+        offset = 0
+        if self.resume_sampler is not None:
+            state, offset = self.resume_sampler
+            self.rng.set_state(state)
+            self.resume_sampler = None
+
+        t = 0
+        while num_batches is None or t < num_batches:
+            if self.sampling == 'random':
+                batch = self.rng.choice(num_train, self.batch_size)
+                t += 1
+                self.sampler_states[t] = (self.rng.get_state(), 0)
+                yield batch
+                continue
+
+            # One pass over a fresh permutation of the training data.
+            pass_state = self.rng.get_state()
+            order = self.rng.permutation(num_train)
+            stop = num_train
+            if self.drop_last:
+                stop -= num_train % self.batch_size
+            for start in range(offset, stop, self.batch_size):
+                if num_batches is not None and t >= num_batches:
+                    return
+                t += 1
+                if start + self.batch_size < stop:
+                    self.sampler_states[t] = (pass_state,
+                                              start + self.batch_size)
+                else:
+                    self.sampler_states[t] = (self.rng.get_state(), 0)
+                yield order[start:start + self.batch_size]
+            offset = 0
+
+
+    def _make_batch_loader(self, num_batches=None):
+        """
+        Create the BatchLoader that _step draws minibatches from.
+
+        If the augment function draws from a generator of its own (an rng
+        attribute, as augmentation.Augmenter has), the generator state after
+        every minibatch is recorded in augment_states, since augmentation may
+        run ahead of training on the loader thread.
+        """
+        transform = self.augment
+        augment_rng = _augment_rng(self.augment)
+        if augment_rng is not None:
+            num_augmented = [0]
+
+            def transform(X_batch, y_batch):
+                X_batch, y_batch = self.augment(X_batch, y_batch)
+                num_augmented[0] += 1
+                self.augment_states[num_augmented[0]] = augment_rng.get_state()
+                return X_batch, y_batch
+
+        return BatchLoader(self.X_train, self.y_train,
+                           self._batch_indices(num_batches),
+                           num_buffers=self.num_prefetch + 1,
+                           transform=transform)
+
+
+    def _save_checkpoint(self, num_batches):
+        """
+        Hand a snapshot of the training state after num_batches minibatches
+        of the current call to train() to the checkpoint writer.
+        """
         if self.checkpoint_name is None:
             return
 
-        checkpoint = {
-            'model': self.model,
-            'update_rule': self.update_rule,
-            'lr_decay': self.lr_decay,
-            'optim_config': self.optim_config,
-            'batch_size': self.batch_size,
-            'num_train_samples': self.num_train_samples,
-            'num_val_samples': self.num_val_samples,
+        arrays = {}
+        meta = {
+            'update_rule': self.update_rule.__name__,
             'epoch': self.epoch,
-            'loss_history': self.loss_history,
-            'train_acc_history': self.train_acc_history,
-            'val_acc_history': self.val_acc_history,
+            'best_val_acc': float(self.best_val_acc),
+            'optim_configs': {},
         }
-        filename = '%s_epoch_%d.pkl' % (self.checkpoint_name, self.epoch)
+        for p, w in self.model.params.items():
+            arrays['params/%s' % p] = w.copy()
+        for p, w in self.best_params.items():
+            arrays['best_params/%s' % p] = w.copy()
+        for p, config in self.optim_configs.items():
+            meta['optim_configs'][p] = {}
+            arrays.update(_split_arrays(config, meta['optim_configs'][p],
+                                        'optim_configs/%s/' % p))
+        if hasattr(self.model, 'bn_params'):
+            meta['bn_params'] = []
+            for i, bn_param in enumerate(self.model.bn_params):
+                meta['bn_params'].append({})
+                arrays.update(_split_arrays(bn_param, meta['bn_params'][i],
+                                            'bn_params/%d/' % i))
+        arrays['loss_history'] = np.array(self.loss_history, dtype=np.float64)
+        arrays['train_acc_history'] = np.array(self.train_acc_history,
+                                               dtype=np.float64)
+        arrays['val_acc_history'] = np.array(self.val_acc_history,
+                                             dtype=np.float64)
+
+        # The generator that draws minibatches, np.random, which models use
+        # e.g. for dropout, and the generator of the augment function.
+        sampler_state, offset = self.sampler_states[num_batches]
+        meta['sampler_offset'] = offset
+        rng_states = [('sampler', sampler_state),
+                      ('np_random', np.random.get_state())]
+        if num_batches in self.augment_states:
+            rng_states.append(('augment', self.augment_states[num_batches]))
+        for name, state in rng_states:
+            arrays['%s_keys' % name] = state[1].copy()
+            meta['%s_state' % name] = [state[0], int(state[2]), int(state[3]),
+                                       float(state[4])]
+
+        filename = '%s_epoch_%d.npz' % (self.checkpoint_name, self.epoch)
         if self.verbose:
             print('Saving checkpoint to "%s"' % filename)
-        with open(filename, 'wb') as f:
-            pickle.dump(checkpoint, f)
+        if self.checkpoint_writer is None:
+            pattern = glob.escape(self.checkpoint_name) + '_epoch_*.npz'
+            self.checkpoint_writer = CheckpointWriter(self.keep_checkpoints,
+                                                      pattern)
+        self.checkpoint_writer.save(filename, arrays, meta)
+
+
+    def resume(self, path):
+        """
+        Restore the training state saved in a checkpoint, so that train()
+        continues exactly where the checkpointed run was: the model
+        parameters, the best parameters so far, the optimizer state (such as
+        the moments of adam), the epoch counter, the histories and the
+        states of the random number generators, including the generator of
+        an augment function that keeps one in an rng attribute (such as
+        augmentation.Augmenter).
+
+        The Solver must have been constructed with the same model
+        architecture, data and options as the one that wrote the checkpoint.
+        Random state inside the worker processes of num_workers > 1 is not
+        restored.
+
+        Inputs:
+        - path: Path of a checkpoint file written by this class.
+        """
+        arrays, meta = load_checkpoint(path)
+        if meta['update_rule'] != self.update_rule.__name__:
+            raise ValueError('Checkpoint was written with update_rule "%s"'
+                             % meta['update_rule'])
+
+        for p in self.model.params:
+            self.model.params[p] = arrays['params/%s' % p]
+        self.best_params = {}
+        for p in self.model.params:
+            if 'best_params/%s' % p in arrays:
+                self.best_params[p] = arrays['best_params/%s' % p]
+        self.optim_configs = {}
+        for p in self.model.params:
+            self.optim_configs[p] = _join_arrays(
+                meta['optim_configs'][p], arrays, 'optim_configs/%s/' % p)
+        if 'bn_params' in meta:
+            self.model.bn_params = [
+                _join_arrays(bn_param, arrays, 'bn_params/%d/' % i)
+                for i, bn_param in enumerate(meta['bn_params'])]
+
+        self.epoch = meta['epoch']
+        self.best_val_acc = meta['best_val_acc']
+        self.loss_history = arrays['loss_history'].tolist()
+        self.train_acc_history = arrays['train_acc_history'].tolist()
+        self.val_acc_history = arrays['val_acc_history'].tolist()
+
+        def rng_state(name):
+            kind, pos, has_gauss, cached_gaussian = meta['%s_state' % name]
+            return (kind, arrays['%s_keys' % name], pos, has_gauss,
+                    cached_gaussian)
+        self.resume_sampler = (rng_state('sampler'), meta['sampler_offset'])
+        np.random.set_state(rng_state('np_random'))
+        augment_rng = _augment_rng(self.augment)
+        if augment_rng is not None and 'augment_state' in meta:
+            augment_rng.set_state(rng_state('augment'))
 
 
     def check_accuracy(self, X, y, num_samples=None, batch_size=100):
@@ -262,22 +611,68 @@ class Solver():
         return acc
 
 
-    def train(self, conv=False): # Modified by Seankala.
+    def _iterations_per_epoch(self):
+        """
+        Number of minibatches that make up an epoch of epoch_size samples.
+        """
+        epoch_size = self.epoch_size
+        if epoch_size is None:
+            epoch_size = self.X_train.shape[0]
+        if self.sampling == 'epoch' and not self.drop_last:
+            # The last minibatch of the epoch may be smaller.
+            num_batches = (epoch_size + self.batch_size - 1) // self.batch_size
+            return max(num_batches, 1)
+        return max(epoch_size // self.batch_size, 1)
+
+
+    def train(self):
         """
         Run optimization to train the model.
         """
-        num_train = self.X_train.shape[0]
+        iterations_per_epoch = self._iterations_per_epoch()
+        start_epoch = self.epoch
+        num_iterations = (self.num_epochs - start_epoch) * iterations_per_epoch
+        if num_iterations <= 0:
+            return
 
-        # Added in by Seankala.
-        if conv:
-            iterations_per_epoch = 200
-        else:
-            iterations_per_epoch = max(num_train // self.batch_size, 1)
+        if self.batch_loader is not None:
+            self.batch_loader.close()
+        # Fork the workers before the loader starts its thread.
+        if self.num_workers > 1:
+            self._start_workers()
+        self.sampler_states = {}
+        self.augment_states = {}
+        try:
+            self.batch_loader = self._make_batch_loader(num_iterations)
+            try:
+                self._train_loop(num_iterations, iterations_per_epoch,
+                                 start_epoch == 0)
+            finally:
+                self.batch_loader.close()
+                self.batch_loader = None
+        finally:
+            self._stop_workers()
+            # Wait for the last checkpoints to reach the disk.
+            if self.checkpoint_writer is not None:
+                writer, self.checkpoint_writer = self.checkpoint_writer, None
+                writer.close()
+
+        # At the end of training swap the best params into the model
+        self.model.params = self.best_params
 
-        num_iterations = self.num_epochs * iterations_per_epoch
 
+    def _train_loop(self, num_iterations, iterations_per_epoch, check_first):
+        """
+        Run num_iterations steps of optimization; called by train(). The
+        accuracy check on the first iteration is skipped unless check_first,
+        so that a resumed run records the same history as an uninterrupted
+        one.
+        """
         for t in range(num_iterations):
             self._step()
+            # Only the states after this minibatch are still needed.
+            self.sampler_states.pop(t, None)
+            self.augment_states.pop(t, None)
 
             # Maybe print training loss
             if self.verbose and t % self.print_every == 0:
@@ -293,14 +688,14 @@ class Solver():
 
             # Check train and val accuracy on the first iteration, the last
             # iteration, and at the end of each epoch.
-            first_it = (t == 0)
+            first_it = (t == 0) and check_first
             last_it = (t == num_iterations - 1)
             if first_it or last_it or epoch_end:
+                self._sync_workers()
                 train_acc = self.check_accuracy(self.X_train, self.y_train, num_samples=self.num_train_samples)
                 val_acc = self.check_accuracy(self.X_val, self.y_val, num_samples=self.num_val_samples)
                 self.train_acc_history.append(train_acc)
                 self.val_acc_history.append(val_acc)
-                self._save_checkpoint()
 
                 if self.verbose:
                     print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (self.epoch, self.num_epochs, train_acc, val_acc))
@@ -312,5 +707,89 @@ class Solver():
                     for k, v in self.model.params.items():
                         self.best_params[k] = v.copy()
 
-        # At the end of training swap the best params into the model
-        self.model.params = self.best_params
+                # Checkpoints are only written at the end of an epoch, where
+                # training can be resumed.
+                if epoch_end:
+                    self._save_checkpoint(t + 1)
+
+
+def _augment_rng(augment):
+    """
+    The numpy RandomState an augment function draws from, or None if it does
+    not keep one in an rng attribute.
+    """
+    rng = getattr(augment, 'rng', None)
+    if isinstance(rng, np.random.RandomState):
+        return rng
+    return None
+
+
+def _split_arrays(config, meta, prefix):
+    """
+    Split a dictionary such as an optim_config into its numpy arrays, which
+    are returned as checkpoint entries named prefix + key, and its other
+    values, which are stored in meta.
+    """
+    arrays = {}
+    for k, v in config.items():
+        if isinstance(v, np.ndarray):
+            arrays[prefix + k] = v.copy()
+        elif isinstance(v, np.generic):
+            meta[k] = v.item()
+        else:
+            meta[k] = v
+    return arrays
+
+
+def _join_arrays(meta, arrays, prefix):
+    """ Inverse of _split_arrays. """
+    config = dict(meta)
+    for name, v in arrays.items():
+        if name.startswith(prefix) and '/' not in name[len(prefix):]:
+            config[name[len(prefix):]] = v
+    return config
+
+
+def _shared_array(ctx, shape, dtype):
+    """
+    Allocate a numpy array in memory that is shared with processes forked
+    from this one.
+    """
+    dtype = np.dtype(dtype)
+    num_bytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    raw = ctx.RawArray('b', num_bytes)
+    return np.frombuffer(raw, dtype=dtype,
+                         count=int(np.prod(shape))).reshape(shape)
+
+
+def _data_parallel_worker(model, worker_id, conn, shared_X, shared_y,
+                          shared_grads, seed):
+    """
+    Serve requests of a data-parallel Solver in a worker process, until None
+    is received. The model parameters live in shared memory, so the replica
+    always sees the latest update.
+
+    Requests are tuples:
+    - ('loss', start, stop): Compute the loss and gradients of rows
+      start:stop of the shared minibatch, write the gradients to this
+      worker's row of shared_grads and reply with the loss.
+    - ('bn_params',): Reply with model.bn_params.
+    """
+    np.random.seed(seed)
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        try:
+            if request[0] == 'loss':
+                start, stop = request[1:]
+                loss, grads = model.loss(shared_X[start:stop],
+                                         shared_y[start:stop])
+                for p, dw in grads.items():
+                    shared_grads[p][worker_id] = dw
+                conn.send(('ok', loss))
+            elif request[0] == 'bn_params':
+                conn.send(('ok', model.bn_params))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()